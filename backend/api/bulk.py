@@ -0,0 +1,231 @@
+import json
+import os
+from base64 import b64encode
+from itertools import islice
+from time import monotonic
+
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import Prefetch
+
+from recipes.images import schedule_renditions
+from recipes.models import (
+    ImportCheckpoint, Ingredient, MediaFile, Recipe, RecipeIngredients,
+    RecipeScore, RecipeVector, Tag, tags_mask
+)
+from .serializers import RecipeImportSerializer
+from .signals import index_recipes, invalidate
+
+User = get_user_model()
+
+
+def read_ndjson(lines, start=0):
+    # Номера строк физические: пустые строки пропускаются, но считаются.
+    for number, line in enumerate(lines, 1):
+        if number <= start:
+            continue
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def to_pks(values):
+    pks = set()
+    for value in values if isinstance(values, list) else ():
+        if isinstance(value, dict):
+            value = value.get('id')
+        try:
+            pks.add(int(value))
+        except (TypeError, ValueError):
+            continue
+    return pks
+
+
+class RecipeImporter:
+    max_errors = 100
+
+    def __init__(self, author, batch_size=500, start=0,
+                 checkpoint=None, report=None):
+        self.author = author
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.position = start
+        if checkpoint is not None:
+            self.position = ImportCheckpoint.objects.get_position(checkpoint)
+        self.report = report or (lambda stats: None)
+        self.stats = {'rows': 0, 'created': 0, 'invalid': 0}
+        self.errors = []
+
+    def import_rows(self, lines):
+        started = monotonic()
+        items = read_ndjson(lines, self.position)
+        batch = list(islice(items, self.batch_size))
+        while batch:
+            self.import_batch(batch)
+            self.stats['elapsed'] = monotonic() - started
+            self.report(self.stats)
+            batch = list(islice(items, self.batch_size))
+        return self.stats
+
+    def preload(self, batch):
+        items = [item for _, item in batch if isinstance(item, dict)]
+        tag_ids = set().union(*(to_pks(item.get('tags')) for item in items))
+        ingredient_ids = set().union(
+            *(to_pks(item.get('ingredients')) for item in items)
+        )
+        return {
+            'tags': Tag.objects.in_bulk(tag_ids),
+            'ingredients': set(Ingredient.objects.filter(
+                id__in=ingredient_ids
+            ).values_list('id', flat=True)),
+        }
+
+    def add_error(self, line, errors):
+        self.stats['invalid'] += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def validate(self, batch):
+        context = {'author': self.author, 'preloaded': self.preload(batch)}
+        rows = []
+        for line, item in batch:
+            if not isinstance(item, dict):
+                self.add_error(line, ['Некорректный JSON'])
+                continue
+            serializer = RecipeImportSerializer(data=item, context=context)
+            if serializer.is_valid():
+                rows.append(serializer.validated_data)
+            else:
+                self.add_error(line, serializer.errors)
+        return rows
+
+    def import_batch(self, batch):
+        self.stats['rows'] += len(batch)
+        rows = self.validate(batch)
+        # Позиция фиксируется в той же транзакции, что и рецепты, поэтому
+        # после сбоя пачка не загрузится повторно.
+        with transaction.atomic():
+            if rows:
+                self.save(rows)
+            if self.checkpoint is not None:
+                ImportCheckpoint.objects.save_position(
+                    self.checkpoint, batch[-1][0]
+                )
+        self.position = batch[-1][0]
+        self.stats['created'] += len(rows)
+
+    def finish(self):
+        if self.checkpoint is not None:
+            ImportCheckpoint.objects.filter(name=self.checkpoint).delete()
+
+    @transaction.atomic
+    def save(self, rows):
+        recipes = [
+            Recipe(
+                tags_mask=tags_mask(tag.pk for tag in row['tags']),
+                **{
+                    key: value for key, value in row.items()
+                    if key not in ('tags', 'ingredients')
+                }
+            )
+            for row in rows
+        ]
+        self.create_recipes(recipes)
+        RecipeTags = Recipe.tags.through
+        RecipeTags.objects.bulk_create([
+            RecipeTags(recipe_id=recipe.pk, tag_id=tag.pk)
+            for recipe, row in zip(recipes, rows)
+            for tag in row['tags']
+        ])
+        RecipeIngredients.objects.bulk_create([
+            RecipeIngredients(
+                recipe_id=recipe.pk,
+                ingredient_id=ingredient['ingredient']['id'],
+                amount=ingredient['amount']
+            )
+            for recipe, row in zip(recipes, rows)
+            for ingredient in row['ingredients']
+        ])
+        User.objects.adjust_counters(
+            self.author.pk, recipes_count=len(recipes)
+        )
+        ids = [recipe.pk for recipe in recipes]
+        RecipeVector.objects.rebuild(ids)
+        index_recipes(Recipe.objects.filter(pk__in=ids))
+        invalidate((
+            'recipes', f'recipes:author:{self.author.pk}',
+            *(f'recipes:tag:{tag.slug}' for row in rows for tag in row['tags'])
+        ))
+
+    def create_recipes(self, recipes):
+        features = connections[Recipe.objects.db].features
+        if not features.can_return_ids_from_bulk_insert:
+            # Без RETURNING первичные ключи не заполняются,
+            # поэтому рецепты сохраняются по одному.
+            for recipe in recipes:
+                recipe.save()
+            return
+        Recipe.objects.bulk_create(recipes)
+        RecipeScore.objects.bulk_create(
+            RecipeScore(recipe_id=recipe.pk) for recipe in recipes
+        )
+        MediaFile.objects.acquire(recipe.image.name for recipe in recipes)
+        for recipe in recipes:
+            schedule_renditions(recipe.pk)
+
+
+class RecipeExporter:
+    def __init__(self, batch_size=500, inline_images=False, build_url=None):
+        self.batch_size = batch_size
+        self.inline_images = inline_images
+        self.build_url = build_url or (lambda url: url)
+
+    def batches(self):
+        recipes = Recipe.objects.select_related('author').prefetch_related(
+            Prefetch('tags', queryset=Tag.objects.all()),
+            'recipeingredients_set'
+        ).order_by('pk')
+        last = 0
+        while True:
+            batch = list(recipes.filter(pk__gt=last)[:self.batch_size])
+            if not batch:
+                return
+            yield batch
+            last = batch[-1].pk
+
+    def image(self, recipe):
+        if not recipe.image:
+            return None
+        if not self.inline_images:
+            return self.build_url(recipe.image.url)
+        ext = os.path.splitext(recipe.image.name)[1][1:]
+        with recipe.image.open('rb') as file:
+            content = b64encode(file.read()).decode()
+        return f'data:image/{ext};base64,{content}'
+
+    def serialize(self, recipe):
+        return {
+            'id': recipe.pk,
+            'author': recipe.author.username,
+            'name': recipe.name,
+            'text': recipe.description,
+            'cooking_time': recipe.cooking_time,
+            'tags': [tag.pk for tag in recipe.tags.all()],
+            'ingredients': [
+                {'id': row.ingredient_id, 'amount': row.amount}
+                for row in recipe.recipeingredients_set.all()
+            ],
+            'image': self.image(recipe),
+        }
+
+    def stream(self):
+        for batch in self.batches():
+            yield ''.join(
+                json.dumps(self.serialize(recipe), ensure_ascii=False) + '\n'
+                for recipe in batch
+            ).encode('utf-8')
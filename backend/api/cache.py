@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from rest_framework.renderers import JSONRenderer
+
+from recipes.models import DataVersion
+
+
+class ReferenceCache:
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1:]
+
+    def set(self, key, version, content):
+        etag = quote_etag(md5(content).hexdigest())
+        with self.lock:
+            self.entries[key] = (version, content, etag)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return content, etag
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+reference_cache = ReferenceCache()
+
+
+class ReferenceCacheMixin:
+    cache_name = None
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def cached_response(self, method, request, *args, **kwargs):
+        if not isinstance(request.accepted_renderer, JSONRenderer):
+            return method(request, *args, **kwargs)
+        version = DataVersion.objects.get_version(self.cache_name)
+        key = (self.cache_name, request.get_full_path())
+        entry = reference_cache.get(key, version)
+        if entry is None:
+            response = method(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            entry = reference_cache.set(
+                key, version, JSONRenderer().render(response.data)
+            )
+        content, etag = entry
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(
+                content, content_type='application/json'
+            )
+        response['ETag'] = etag
+        return response
+
+
+class ResponseCache:
+    prefix = 'responses'
+
+    def __init__(self, name='pages', alias=None, timeout=None):
+        self.name = name
+        self.alias = alias
+        self.timeout = timeout
+
+    def get_options(self):
+        options = getattr(settings, 'RESPONSE_CACHE', {})
+        return (
+            self.alias or options.get('CACHE', 'responses'),
+            self.timeout or options.get('TIMEOUT', 600)
+        )
+
+    @property
+    def cache(self):
+        return caches[self.get_options()[0]]
+
+    def make_key(self, *parts):
+        return ':'.join((self.prefix, *map(str, parts)))
+
+    def dependency_keys(self, dependencies):
+        return [self.make_key('dep', name) for name in dependencies]
+
+    def get(self, key):
+        entry = self.cache.get(self.make_key('page', key))
+        if entry is None:
+            self.count('misses')
+            return None
+        started, dependencies, content = entry
+        keys = self.dependency_keys(dependencies)
+        changed = self.cache.get_many(keys)
+        if len(changed) != len(keys) or any(
+            value > started for value in changed.values()
+        ):
+            self.count('misses')
+            return None
+        self.count('hits')
+        return content
+
+    def set(self, key, started, dependencies, content):
+        # Метки зависимостей живут столько же, сколько страницы: пропавшая
+        # метка означает промах, а не устаревший ответ.
+        timeout = self.get_options()[1]
+        for dependency_key in self.dependency_keys(dependencies):
+            self.cache.add(dependency_key, started, timeout)
+        self.cache.set(
+            self.make_key('page', key),
+            (started, sorted(dependencies), content),
+            timeout
+        )
+
+    def invalidate(self, dependencies):
+        now = time()
+        self.cache.set_many(
+            {key: now for key in self.dependency_keys(dependencies)},
+            self.get_options()[1]
+        )
+
+    def count(self, name):
+        key = self.make_key('stats', self.name, name)
+        self.cache.add(key, 0, None)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            pass
+
+    def stats(self):
+        names = ('hits', 'misses')
+        keys = {
+            name: self.make_key('stats', self.name, name) for name in names
+        }
+        values = self.cache.get_many(list(keys.values()))
+        stats = {name: values.get(key, 0) for name, key in keys.items()}
+        total = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / total if total else None
+        return stats
+
+
+response_cache = ResponseCache()
+feed_cache = ResponseCache('feed')
+
+
+class AnonymousListCacheMixin:
+    response_cache_params = ()
+
+    def list(self, request, *args, **kwargs):
+        if (
+            request.user.is_authenticated
+            or not isinstance(request.accepted_renderer, JSONRenderer)
+        ):
+            return super().list(request, *args, **kwargs)
+        key = self.get_response_cache_key(request)
+        content = response_cache.get(key)
+        if content is None:
+            started = time()
+            response = super().list(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            content = JSONRenderer().render(response.data)
+            response_cache.set(
+                key, started,
+                self.get_response_dependencies(request, response.data),
+                content
+            )
+        return HttpResponse(content, content_type='application/json')
+
+    def get_response_cache_params(self):
+        params = set(self.filterset_class.base_filters)
+        params.update(self.response_cache_params)
+        paginator = self.paginator
+        if paginator is not None:
+            params.update(
+                getattr(paginator, name)
+                for name in (
+                    'page_query_param', 'page_size_query_param',
+                    'cursor_query_param', 'count_query_param'
+                )
+                if getattr(paginator, name, None)
+            )
+        return sorted(params)
+
+    def get_response_cache_key(self, request):
+        query = []
+        for name in self.get_response_cache_params():
+            if name in request.query_params:
+                query.append((
+                    name, sorted(set(request.query_params.getlist(name)))
+                ))
+        return md5(repr((
+            request.build_absolute_uri(request.path), query
+        )).encode()).hexdigest()
+
+    def get_response_dependencies(self, request, data):
+        dependencies = {
+            f'recipes:tag:{slug}'
+            for slug in request.query_params.getlist('tags') if slug
+        }
+        author = request.query_params.get('author')
+        if author:
+            dependencies.add(f'recipes:author:{author}')
+        if request.query_params.get('search'):
+            dependencies.add('recipes:search')
+        ordering = request.query_params.get('ordering')
+        if ordering in ('popular', 'trending'):
+            dependencies.add(f'recipes:ordering:{ordering}')
+        if not dependencies:
+            dependencies.add('recipes')
+        for recipe in data.get('results', ()):
+            dependencies.add(f'recipe:{recipe["id"]}')
+            dependencies.add(f'user:{recipe["author"]["id"]}')
+            dependencies.update(f'tag:{tag["id"]}' for tag in recipe['tags'])
+            dependencies.update(
+                f'ingredient:{ingredient["id"]}'
+                for ingredient in recipe['ingredients']
+            )
+        return dependencies
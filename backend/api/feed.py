@@ -0,0 +1,109 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from heapq import merge
+from itertools import groupby, islice
+from operator import itemgetter
+from time import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+
+from recipes.models import Recipe
+from users.models import Subscription
+from .cache import feed_cache
+
+DEFAULTS = {
+    'CACHE': True,
+    'CACHE_MIN_AUTHORS': 100,
+    'CACHE_SIZE': 120,
+}
+
+
+def get_feed_settings():
+    return {**DEFAULTS, **getattr(settings, 'RECIPE_FEED', {})}
+
+
+def encode_cursor(position):
+    pub_date, pk = position
+    data = json.dumps({'p': [pub_date.isoformat(), pk]})
+    return urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        pub_date, pk = json.loads(urlsafe_b64decode(cursor.encode()))['p']
+        position = parse_datetime(pub_date), int(pk)
+    except (TypeError, ValueError, KeyError):
+        raise NotFound('Неверный курсор')
+    if position[0] is None:
+        raise NotFound('Неверный курсор')
+    return position
+
+
+class RecipeFeed:
+    def __init__(self, user):
+        self.user = user
+        self.options = get_feed_settings()
+        self.authors = Subscription.objects.filter(
+            subscriber=user
+        ).values('author')
+
+    def merge(self, position, size):
+        recipes = Recipe.objects.all()
+        if position is not None:
+            pub_date, pk = position
+            recipes = recipes.filter(
+                Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk)
+            )
+        rows = recipes.first_per_author(self.authors, size).order_by(
+            'author', '-pub_date', '-pk'
+        ).values_list('author', 'pub_date', 'pk')
+        runs = [
+            [(pub_date, pk) for _, pub_date, pk in group]
+            for _, group in groupby(rows, key=itemgetter(0))
+        ]
+        return list(islice(merge(*runs, reverse=True), size))
+
+    def use_cache(self, position, size):
+        return (
+            self.options['CACHE']
+            and position is None
+            and size < self.options['CACHE_SIZE']
+            and self.authors.count() >= self.options['CACHE_MIN_AUTHORS']
+        )
+
+    def cached_head(self):
+        key = f'feed:{self.user.pk}'
+        entry = feed_cache.get(key)
+        if entry is not None:
+            built, entries = entry
+            if not Recipe.objects.filter(
+                author__in=self.authors, pub_date__gt=built
+            ).exists():
+                return entries
+        started, built = time(), timezone.now()
+        entries = self.merge(None, self.options['CACHE_SIZE'])
+        feed_cache.set(key, started, {key}, (built, entries))
+        return entries
+
+    def page(self, queryset, position, size):
+        cached = self.use_cache(position, size)
+        if cached:
+            entries = self.cached_head()[:size + 1]
+        else:
+            entries = self.merge(position, size + 1)
+        recipes = queryset.in_bulk([pk for _, pk in entries[:size]])
+        if cached and len(recipes) < len(entries[:size]):
+            # В кэше остался удалённый рецепт: собираем страницу заново.
+            entries = self.merge(position, size + 1)
+            recipes = queryset.in_bulk([pk for _, pk in entries[:size]])
+        results = [
+            recipes[pk] for _, pk in entries[:size] if pk in recipes
+        ]
+        next_position = entries[size - 1] if len(entries) > size else None
+        return results, next_position
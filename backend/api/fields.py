@@ -1,15 +1,203 @@
 import base64
+import binascii
+from tempfile import SpooledTemporaryFile
+from urllib.parse import unquote, urlsplit
 
-from django.core.files.base import ContentFile
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from PIL import ImageFile
 from rest_framework import serializers
 
+from recipes.images import get_image_settings, select_rendition
+
 
 class Base64ImageField(serializers.ImageField):
+    default_error_messages = {
+        'invalid_base64': 'Некорректные данные изображения.',
+        'invalid_image': 'Файл не является изображением или повреждён.',
+        'too_large': 'Размер изображения не должен превышать {max_size} байт.',
+        'too_many_pixels': (
+            'Размер изображения не должен превышать '
+            '{max_width}x{max_height} пикселей.'
+        ),
+    }
+    chunk_size = 64 * 1024
+    memory_size = 1024 * 1024
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            image_format, image_str = data.split(';base64,')
-            ext = image_format.split('/')[-1]
+            data = self.decode(data)
+
+        return super().to_internal_value(data)
+
+    def decode(self, data):
+        options = get_image_settings()
+        try:
+            start = data.index(';base64,')
+        except ValueError:
+            self.fail('invalid_base64')
+        ext = data[:start].split('/')[-1]
+        start += len(';base64,')
+        if (len(data) - start) * 3 // 4 > options['MAX_SIZE']:
+            self.fail('too_large', max_size=options['MAX_SIZE'])
+
+        buffer = SpooledTemporaryFile(max_size=self.memory_size)
+        parser = ImageFile.Parser()
+        for offset in range(start, len(data), self.chunk_size):
+            try:
+                chunk = base64.b64decode(
+                    data[offset:offset + self.chunk_size], validate=True
+                )
+            except (binascii.Error, ValueError):
+                buffer.close()
+                self.fail('invalid_base64')
+            buffer.write(chunk)
+            if parser is not None:
+                parser = self.check_dimensions(parser, chunk, buffer)
+
+        buffer.seek(0)
+        return File(buffer, name='temp.' + ext)
 
-            data = ContentFile(base64.b64decode(image_str), name='temp.' + ext)
+    def check_dimensions(self, parser, chunk, buffer):
+        try:
+            parser.feed(chunk)
+        except Exception:
+            buffer.close()
+            self.fail('invalid_image')
+        if parser.image is None:
+            return parser
+        options = get_image_settings()
+        width, height = parser.image.size
+        if width > options['MAX_WIDTH'] or height > options['MAX_HEIGHT']:
+            buffer.close()
+            self.fail(
+                'too_many_pixels',
+                max_width=options['MAX_WIDTH'],
+                max_height=options['MAX_HEIGHT']
+            )
+        return None
 
+
+class StoredImageField(Base64ImageField):
+    default_error_messages = {
+        'not_stored': 'Изображение {name} не найдено в хранилище.',
+    }
+
+    def __init__(self, storage, **kwargs):
+        self.storage = storage
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) and not data.startswith('data:image'):
+            return self.stored_name(data)
         return super().to_internal_value(data)
+
+    def stored_name(self, data):
+        # Экспорт по умолчанию пишет ссылку на файл: такой файл уже лежит
+        # в хранилище, и рецепт ссылается на него же.
+        name = unquote(urlsplit(data).path)
+        base_url = urlsplit(self.storage.base_url).path
+        if name.startswith(base_url):
+            name = name[len(base_url):]
+        try:
+            stored = bool(name) and self.storage.exists(name)
+        except SuspiciousFileOperation:
+            stored = False
+        if not stored:
+            self.fail('not_stored', name=data)
+        return name
+
+
+class ContextAuthorDefault:
+    requires_context = True
+
+    def __call__(self, serializer_field):
+        return serializer_field.context['author']
+
+
+class PrimaryKeyListField(serializers.Field):
+    default_error_messages = {
+        'not_a_list': 'Ожидался список идентификаторов.',
+        'empty': 'Список не может быть пустым.',
+        'incorrect_type': 'Некорректный идентификатор.',
+        'duplicate': 'Повторяющееся значение.',
+        'does_not_exist': 'Объект не существует.',
+    }
+
+    def __init__(self, queryset, **kwargs):
+        self.queryset = queryset
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, (str, dict)) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list')
+        data = list(data)
+        if not data:
+            self.fail('empty')
+        errors = {}
+        keys = {}
+        seen = set()
+        for index, value in enumerate(data):
+            pk = self.to_pk(value)
+            if pk is None:
+                errors[index] = [self.error_messages['incorrect_type']]
+                continue
+            if pk in seen:
+                errors[index] = [self.error_messages['duplicate']]
+            seen.add(pk)
+            keys[index] = pk
+        objects = self.get_objects(seen)
+        for index, pk in keys.items():
+            if index not in errors and pk not in objects:
+                errors[index] = [self.error_messages['does_not_exist']]
+        if errors:
+            raise serializers.ValidationError(errors)
+        return [objects[pk] for pk in keys.values()]
+
+    def get_objects(self, keys):
+        preloaded = self.context.get('preloaded', {}).get(self.field_name)
+        if preloaded is not None:
+            return preloaded
+        return self.queryset.all().in_bulk(keys) if keys else {}
+
+    def to_pk(self, value):
+        if isinstance(value, bool):
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    def to_representation(self, value):
+        return [item.pk for item in value.all()]
+
+
+class RecipeImageField(serializers.Field):
+    def __init__(self, width=None, **kwargs):
+        self.width = width
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def get_width(self, request):
+        try:
+            return int(request.query_params['image_width'])
+        except (AttributeError, KeyError, ValueError):
+            return self.context.get('image_width', self.width)
+
+    def to_representation(self, recipe):
+        if not recipe.image:
+            return None
+        request = self.context.get('request')
+        image = recipe.image
+        width = self.get_width(request)
+        if width is not None:
+            image_format = 'jpeg'
+            if request and request.query_params.get('image_format') == 'webp':
+                image_format = 'webp'
+            rendition = select_rendition(recipe, width, image_format)
+            if rendition is not None:
+                image = rendition.image
+        if request is None:
+            return image.url
+        return request.build_absolute_uri(image.url)
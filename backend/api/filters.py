@@ -1,13 +1,43 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Count, F
 from django_filters.rest_framework import FilterSet, filters
 
-from recipes.models import Ingredient, Recipe, Tag
+from recipes.models import DataVersion, Ingredient, Recipe, Tag, tags_mask
+from .search import get_ingredient_search, get_recipe_search
 
 User = get_user_model()
 CHOICES_LIST = (
     (0, 0),
     (1, 1)
 )
+RECIPE_ORDERINGS = {
+    'newest': ('-pub_date', '-id'),
+    'popular': ('-popularity', '-id'),
+    'trending': ('-trending', '-id'),
+}
+TAGS_MATCH_CHOICES = (
+    ('any', 'any'),
+    ('all', 'all')
+)
+
+
+class TagRange:
+    # Есть ли теги, не помещающиеся в маску; проверяется заново только
+    # после изменения тегов.
+    def __init__(self):
+        self.version = None
+        self.wide = False
+
+    def has_wide_tags(self):
+        version = DataVersion.objects.get_version('tags')
+        if version != self.version:
+            self.wide = Tag.objects.filter(pk__gt=63).exists()
+            self.version = version
+        return self.wide
+
+
+tag_range = TagRange()
 
 
 class CustomRecipeFilter(FilterSet):
@@ -15,6 +45,12 @@ class CustomRecipeFilter(FilterSet):
         field_name='tags__slug',
         to_field_name='slug',
         queryset=Tag.objects.all(),
+        method='filter_tags'
+    )
+    tags_match = filters.ChoiceFilter(
+        label='tags_match',
+        choices=TAGS_MATCH_CHOICES,
+        method='filter_tags_match'
     )
     is_favorited = filters.ChoiceFilter(
         label='is_favorited',
@@ -27,11 +63,47 @@ class CustomRecipeFilter(FilterSet):
         method='filter_shopping_cart'
     )
     author = filters.NumberFilter(field_name='author', lookup_expr='exact')
+    search = filters.CharFilter(method='filter_search')
+    ordering = filters.ChoiceFilter(
+        label='ordering',
+        choices=[(name, name) for name in RECIPE_ORDERINGS],
+        method='filter_ordering'
+    )
 
     class Meta:
         model = Recipe
         fields = ('tags', 'author')
 
+    def filter_tags(self, queryset, name, value):
+        if not value:
+            return queryset
+        match_all = self.data.get('tags_match') == 'all'
+        mask = self.get_tags_mask(value)
+        if mask is not None:
+            queryset = queryset.annotate(
+                tag_bits=F('tags_mask').bitand(mask)
+            )
+            if match_all:
+                return queryset.filter(tag_bits=mask)
+            return queryset.exclude(tag_bits=0)
+        recipes = Recipe.tags.through.objects.filter(tag__in=value)
+        if match_all:
+            recipes = recipes.values('recipe').annotate(
+                matched=Count('tag')
+            ).filter(matched=len(value))
+        return queryset.filter(pk__in=recipes.values('recipe'))
+
+    def filter_tags_match(self, queryset, name, value):
+        return queryset
+
+    def get_tags_mask(self, tags):
+        if not getattr(settings, 'RECIPE_FILTERS', {}).get('TAG_BITMASK'):
+            return None
+        mask = tags_mask(tag.pk for tag in tags)
+        if mask is None or tag_range.has_wide_tags():
+            return None
+        return mask
+
     def filter_authenticated(self, queryset, name, value):
         if not value:
             return queryset
@@ -47,10 +119,26 @@ class CustomRecipeFilter(FilterSet):
             queryset, 'in_shopping_cart__user', value
         )
 
+    def filter_search(self, queryset, name, value):
+        return get_recipe_search().search(queryset, value)
+
+    def filter_ordering(self, queryset, name, value):
+        if value == 'newest':
+            return queryset.order_by(*RECIPE_ORDERINGS[value])
+        # Строка рейтинга создаётся вместе с рецептом, поэтому INNER JOIN
+        # ничего не теряет и позволяет читать рецепты по индексу рейтинга.
+        return queryset.filter(score__isnull=False).annotate(
+            popularity=F('score__popular'),
+            trending=F('score__trending')
+        ).order_by(*RECIPE_ORDERINGS[value])
+
 
 class CustomIngredientFilter(FilterSet):
-    name = filters.CharFilter(field_name='name', lookup_expr='istartswith')
+    name = filters.CharFilter(method='filter_name')
 
     class Meta:
         model = Ingredient
         fields = ('name',)
+
+    def filter_name(self, queryset, name, value):
+        return get_ingredient_search().search(queryset, value)
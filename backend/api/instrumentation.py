@@ -0,0 +1,252 @@
+import logging
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import ExitStack
+from threading import Lock
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'PATH_PREFIX': '/api/',
+    'SLOW_REQUEST_MS': 500,
+    'DUPLICATE_THRESHOLD': 2,
+    'SLOW_LOG_STATEMENTS': 5,
+    'WINDOW': 1000,
+    'BUCKETS_MS': (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+}
+
+
+def get_instrumentation_settings():
+    return {**DEFAULTS, **getattr(settings, 'INSTRUMENTATION', {})}
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * share))], 2)
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    def duplicates(self, threshold):
+        return [
+            (sql, count) for sql, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+
+class RequestHistograms:
+    fields = ('total', 'db', 'serialize', 'render', 'queries', 'size')
+
+    def __init__(self, window, buckets):
+        self.window = window
+        self.buckets = buckets
+        self.samples = {}
+        self.lock = Lock()
+
+    def add(self, view, sample):
+        with self.lock:
+            if view not in self.samples:
+                self.samples[view] = deque(maxlen=self.window)
+            self.samples[view].append(sample)
+
+    def histogram(self, values):
+        counts = [0] * (len(self.buckets) + 1)
+        for value in values:
+            counts[bisect_left(self.buckets, value)] += 1
+        labels = [f'<={bucket}' for bucket in self.buckets]
+        return dict(zip(labels + [f'>{self.buckets[-1]}'], counts))
+
+    def summary(self, samples):
+        result = {'requests': len(samples)}
+        for position, field in enumerate(self.fields):
+            values = sorted(
+                sample[position] for sample in samples
+                if sample[position] is not None
+            )
+            result[field] = {
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': round(values[-1], 2) if values else None,
+            }
+        result['total']['histogram_ms'] = self.histogram(
+            sample[0] for sample in samples
+        )
+        return result
+
+    def stats(self):
+        with self.lock:
+            samples = {
+                view: list(values) for view, values in self.samples.items()
+            }
+        return {
+            view: self.summary(values)
+            for view, values in sorted(samples.items())
+        }
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+
+def create_histograms():
+    options = get_instrumentation_settings()
+    return RequestHistograms(options['WINDOW'], options['BUCKETS_MS'])
+
+
+histograms = create_histograms()
+
+
+class TimedSerializer:
+    def __init__(self, serializer, request):
+        self.serializer = serializer
+        self.request = request
+
+    def __getattr__(self, name):
+        return getattr(self.serializer, name)
+
+    @property
+    def data(self):
+        started = perf_counter()
+        try:
+            return self.serializer.data
+        finally:
+            self.request.serialize_time += perf_counter() - started
+
+
+class SerializationTimingMixin:
+    # Сериализаторы работают внутри представления, поэтому их время
+    # учитывается здесь, а не в middleware.
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        request = getattr(self.request, '_request', self.request)
+        if not hasattr(request, 'serialize_time'):
+            return serializer
+        return TimedSerializer(serializer, request)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    view_class = getattr(match.func, 'cls', None)
+    if view_class is None:
+        return match.view_name
+    actions = getattr(match.func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return f'{view_class.__name__}.{action}'
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.options = get_instrumentation_settings()
+        if not self.options['ENABLED']:
+            raise MiddlewareNotUsed
+
+    def __call__(self, request):
+        if not request.path.startswith(self.options['PATH_PREFIX']):
+            return self.get_response(request)
+        recorder = QueryRecorder()
+        request.serialize_time = 0
+        request.render_time = 0
+        started = perf_counter()
+        with self.recording(recorder):
+            response = self.get_response(request)
+        timings = self.timings(request, recorder, perf_counter() - started)
+        response['Server-Timing'] = self.server_timing(timings, recorder)
+        if response.streaming:
+            response.streaming_content = self.stream(
+                request, response, recorder, started,
+                response.streaming_content
+            )
+        else:
+            self.record(request, response, recorder, timings)
+        return response
+
+    def recording(self, recorder):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        return stack
+
+    def stream(self, request, response, recorder, started, content):
+        # Потоковый ответ читает базу уже после выхода из представления.
+        try:
+            with self.recording(recorder):
+                yield from content
+        finally:
+            self.record(request, response, recorder, self.timings(
+                request, recorder, perf_counter() - started
+            ))
+
+    def process_template_response(self, request, response):
+        started = perf_counter()
+
+        def rendered(response):
+            request.render_time = perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    def timings(self, request, recorder, total):
+        return {
+            'db': recorder.duration * 1000,
+            'serialize': request.serialize_time * 1000,
+            'render': request.render_time * 1000,
+            'total': total * 1000,
+        }
+
+    def server_timing(self, timings, recorder):
+        return ', '.join((
+            f'db;dur={timings["db"]:.1f};desc="{recorder.count} queries"',
+            f'serialize;dur={timings["serialize"]:.1f}',
+            f'render;dur={timings["render"]:.1f}',
+            f'total;dur={timings["total"]:.1f}',
+        ))
+
+    def record(self, request, response, recorder, timings):
+        size = None if response.streaming else len(response.content)
+        name = view_name(request)
+        if name is None:
+            return
+        histograms.add(name, (
+            timings['total'], timings['db'], timings['serialize'],
+            timings['render'], recorder.count, size
+        ))
+        if timings['total'] >= self.options['SLOW_REQUEST_MS']:
+            self.log_slow_request(request, name, timings, recorder)
+
+    def log_slow_request(self, request, name, timings, recorder):
+        duplicates = recorder.duplicates(self.options['DUPLICATE_THRESHOLD'])
+        logger.warning(
+            'Slow request %s %s (%s): %.1f ms, %d queries, %.1f ms in db, '
+            '%d duplicated statements%s',
+            request.method, request.get_full_path(), name,
+            timings['total'], recorder.count, timings['db'],
+            len(duplicates),
+            ''.join(
+                f'\n  {count}x {sql}' for sql, count in
+                duplicates[:self.options['SLOW_LOG_STATEMENTS']]
+            )
+        )
@@ -0,0 +1,135 @@
+from array import array
+from collections import Counter, defaultdict, namedtuple
+from datetime import timedelta
+from heapq import nlargest
+from threading import Lock
+
+from django.conf import settings
+from django.utils import timezone
+
+from recipes.models import DataVersion, RecipeVector
+
+DEFAULTS = {
+    'LIMIT': 1000,
+    'OVERLAP': timedelta(minutes=5),
+}
+
+_index = None
+
+# Итоги и списки рецептов по ингредиентам меняются только вместе, новым
+# снимком, поэтому запрос никогда не видит их вперемешку.
+Snapshot = namedtuple('Snapshot', ('totals', 'postings', 'ingredients'))
+
+
+def get_matching_settings():
+    return {**DEFAULTS, **getattr(settings, 'RECIPE_MATCHING', {})}
+
+
+def get_recipe_index():
+    global _index
+    if _index is None:
+        _index = RecipeIngredientIndex(get_matching_settings())
+    return _index
+
+
+def unpack_ids(value):
+    ids = array('I')
+    ids.frombytes(value)
+    return ids
+
+
+class RecipeIngredientIndex:
+    def __init__(self, options):
+        self.limit = options['LIMIT']
+        self.overlap = options['OVERLAP']
+        self.version = None
+        self.loaded = None
+        self.snapshot = Snapshot({}, {}, {})
+        self.lock = Lock()
+
+    def build(self, vectors):
+        totals = {}
+        postings = defaultdict(lambda: array('I'))
+        ingredients = {}
+        for pk in sorted(vectors):
+            value = vectors[pk][0]
+            ingredients[pk] = value
+            ids = unpack_ids(value)
+            totals[pk] = len(ids)
+            for ingredient_id in ids:
+                postings[ingredient_id].append(pk)
+        return Snapshot(totals, dict(postings), ingredients)
+
+    def apply(self, snapshot, vectors, deleted):
+        totals = dict(snapshot.totals)
+        postings = dict(snapshot.postings)
+        ingredients = dict(snapshot.ingredients)
+        removed = defaultdict(set)
+        added = defaultdict(set)
+        for pk in deleted:
+            for ingredient_id in unpack_ids(ingredients.pop(pk, b'')):
+                removed[ingredient_id].add(pk)
+            totals.pop(pk, None)
+        for pk, (value, _) in vectors.items():
+            old = set(unpack_ids(ingredients.get(pk, b'')))
+            new = set(unpack_ids(value))
+            for ingredient_id in old - new:
+                removed[ingredient_id].add(pk)
+            for ingredient_id in new - old:
+                added[ingredient_id].add(pk)
+            ingredients[pk] = value
+            totals[pk] = len(new)
+        # Меняем только затронутые списки, остальные делятся со старым
+        # снимком.
+        for ingredient_id in removed.keys() | added.keys():
+            ids = set(postings.get(ingredient_id, ()))
+            ids -= removed[ingredient_id]
+            ids |= added[ingredient_id]
+            if ids:
+                postings[ingredient_id] = array('I', sorted(ids))
+            else:
+                postings.pop(ingredient_id, None)
+        return Snapshot(totals, postings, ingredients)
+
+    def refresh(self):
+        version = DataVersion.objects.get_version('recipe_vectors')
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            started = timezone.now()
+            since = None if self.loaded is None else self.loaded - self.overlap
+            snapshot = self.snapshot
+            vectors, deleted = RecipeVector.objects.changes(
+                since, snapshot.totals
+            )
+            if since is None:
+                self.snapshot = self.build(vectors)
+            elif vectors or deleted:
+                vectors = {
+                    pk: value for pk, value in vectors.items()
+                    if snapshot.ingredients.get(pk) != value[0]
+                }
+                self.snapshot = self.apply(snapshot, vectors, deleted)
+            self.loaded = started
+            self.version = version
+
+    def match(self, ingredient_ids, min_coverage=0):
+        self.refresh()
+        snapshot = self.snapshot
+        matched = Counter()
+        for pk in set(ingredient_ids):
+            matched.update(snapshot.postings.get(pk, ()))
+        totals = snapshot.totals
+        ranked = nlargest(
+            self.limit,
+            (
+                (count / totals[pk], count, pk)
+                for pk, count in matched.items()
+                if count >= min_coverage * totals[pk]
+            )
+        )
+        return [
+            (pk, count, totals[pk]) for _, count, pk in ranked
+        ]
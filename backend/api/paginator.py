@@ -1,7 +1,174 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def explain_plan(queryset, analyze=False):
+    # QuerySet.explain(format='json') в Django 2.2 возвращает repr списка,
+    # а не JSON, поэтому план запрашиваем напрямую через курсор.
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    options = 'FORMAT JSON, ANALYZE' if analyze else 'FORMAT JSON'
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN ({options}) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
 
 
 class CustomPageNumberPagination(PageNumberPagination):
     page_size = 6
     page_size_query_param = 'limit'
     max_page_size = 10000
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    approximate_count_threshold = 10000
+    invalid_cursor_message = 'Неверный курсор'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_ordering = getattr(view, 'cursor_ordering', None)
+        self.cursor_mode = bool(
+            self.cursor_ordering
+            and self.cursor_query_param in request.query_params
+        )
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request)
+        ordering = self.cursor_ordering
+        if reverse:
+            ordering = [self.invert(field) for field in ordering]
+
+        page = queryset.order_by(*ordering)
+        if position is not None:
+            features = connections[queryset.db].features
+            try:
+                page = page.filter(
+                    self.keyset_filter(
+                        ordering, position, features.nulls_order_largest
+                    )
+                )
+            except (DjangoValidationError, TypeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        results = list(page[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = position is not None if reverse else has_more
+        self.has_previous = has_more if reverse else position is not None
+        self.results = results
+        self.count = self.get_count(queryset)
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', self.get_cursor_link(self.has_next, -1, False)),
+            ('previous', self.get_cursor_link(self.has_previous, 0, True)),
+            ('results', data)
+        ]))
+
+    def get_count(self, queryset):
+        if self.request.query_params.get(
+            self.count_query_param
+        ) == 'approximate':
+            estimate = self.estimate_count(queryset)
+            if (
+                estimate is not None
+                and estimate >= self.approximate_count_threshold
+            ):
+                return estimate
+        return queryset.count()
+
+    def estimate_count(self, queryset):
+        if connections[queryset.db].vendor != 'postgresql':
+            return None
+        return explain_plan(queryset.order_by())['Plan']['Plan Rows']
+
+    def invert(self, field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    def keyset_filter(self, ordering, position, nulls_largest):
+        # PostgreSQL ставит NULL после всех значений при сортировке по
+        # возрастанию, SQLite - перед ними.
+        conditions = []
+        equal = Q()
+        for field, value in zip(ordering, position):
+            name = field.lstrip('-')
+            nulls_after = nulls_largest != field.startswith('-')
+            if value is None:
+                if not nulls_after:
+                    conditions.append(
+                        equal & Q(**{f'{name}__isnull': False})
+                    )
+                equal &= Q(**{f'{name}__isnull': True})
+                continue
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            after = Q(**{f'{name}__{lookup}': value})
+            if nulls_after:
+                after |= Q(**{f'{name}__isnull': True})
+            conditions.append(equal & after)
+            equal &= Q(**{name: value})
+        if not conditions:
+            return Q(pk__in=[])
+        return reduce(or_, conditions)
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            data = json.loads(urlsafe_b64decode(cursor.encode()))
+            position, reverse = data['p'], bool(data['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if (
+            not isinstance(position, list)
+            or len(position) != len(self.cursor_ordering)
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, instance, reverse):
+        position = [
+            getattr(instance, field.lstrip('-'))
+            for field in self.cursor_ordering
+        ]
+        data = json.dumps({'p': position, 'r': reverse}, cls=CursorEncoder)
+        return urlsafe_b64encode(data.encode()).decode()
+
+    def get_cursor_link(self, exists, index, reverse):
+        if not exists or not self.results:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.page_query_param
+        )
+        return replace_query_param(
+            url, self.cursor_query_param,
+            self.encode_cursor(self.results[index], reverse)
+        )
@@ -0,0 +1,190 @@
+import csv
+from itertools import islice
+
+from rest_framework.renderers import BaseRenderer
+
+SHOPPING_CART_TITLE = 'Список покупок:'
+SHOPPING_CART_HEADER = ('Ингредиент', 'Единица измерения', 'Количество')
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    batch = list(islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(islice(rows, size))
+
+
+def format_line(name, measurement_unit, amount):
+    return f'{name} ({measurement_unit}) - {amount}'
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+class ShoppingCartRenderer(BaseRenderer):
+    charset = 'utf-8'
+    batch_size = 500
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            data = [(key, '', value) for key, value in data.items()]
+        return b''.join(self.stream(data or ()))
+
+    def stream(self, rows):
+        raise NotImplementedError
+
+
+class TextRenderer(ShoppingCartRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+    def stream(self, rows):
+        yield f'{SHOPPING_CART_TITLE} \n'.encode(self.charset)
+        for batch in batched(rows, self.batch_size):
+            yield ''.join(
+                format_line(*row) + '\n' for row in batch
+            ).encode(self.charset)
+
+
+class CSVRenderer(ShoppingCartRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(SHOPPING_CART_HEADER).encode(self.charset)
+        for batch in batched(rows, self.batch_size):
+            yield ''.join(
+                writer.writerow(row) for row in batch
+            ).encode(self.charset)
+
+
+class PDFRenderer(ShoppingCartRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    encoding = 'cp1251'
+    lines_per_page = 50
+
+    def stream(self, rows):
+        document = PDFDocument(self.encoding)
+        yield document.header()
+        yield document.add_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        yield document.add_object(3, document.font())
+
+        lines = (format_line(*row) for row in rows)
+        pages = batched(lines, self.lines_per_page)
+        first_page = [SHOPPING_CART_TITLE, ''] + next(pages, [])
+        yield from self.stream_page(document, first_page)
+        for page in pages:
+            yield from self.stream_page(document, page)
+
+        yield document.add_object(2, document.page_tree())
+        yield document.trailer()
+
+    def stream_page(self, document, lines):
+        content = document.page_content(lines)
+        content_id = document.next_id()
+        yield document.add_object(content_id, content)
+        yield document.add_page(content_id)
+
+
+class PDFDocument:
+    page_size = (595, 842)
+    margin = 50
+    font_size = 11
+    leading = 15
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.offset = 0
+        self.offsets = {}
+        self.pages = []
+        self.last_id = 3
+
+    def next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def write(self, data):
+        self.offset += len(data)
+        return data
+
+    def header(self):
+        return self.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def add_object(self, object_id, body):
+        self.offsets[object_id] = self.offset
+        return self.write(
+            b'%d 0 obj\n' % object_id + body + b'\nendobj\n'
+        )
+
+    def add_page(self, content_id):
+        page_id = self.next_id()
+        self.pages.append(page_id)
+        width, height = self.page_size
+        return self.add_object(page_id, (
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>'
+        ) % (width, height, content_id))
+
+    def font(self):
+        # Стандартный Helvetica без встраивания: кириллица cp1251
+        # переназначается на глифы afii из Adobe Glyph List.
+        differences = b' '.join(
+            b'%d /afii%d' % (code, self.cyrillic_glyph(code))
+            for code in (0xA8, 0xB8, *range(0xC0, 0x100))
+        )
+        return (
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+            b'/Encoding << /Type /Encoding /BaseEncoding /WinAnsiEncoding '
+            b'/Differences [' + differences + b'] >> >>'
+        )
+
+    def cyrillic_glyph(self, code):
+        char = ord(bytes((code,)).decode(self.encoding))
+        if char in (0x401, 0x451):
+            return 10023 if char == 0x401 else 10071
+        first = 0x410 if char < 0x430 else 0x430
+        glyph = (10017 if char < 0x430 else 10065) + char - first
+        return glyph + 1 if char - first >= 6 else glyph
+
+    def escape(self, line):
+        line = line.encode(self.encoding, errors='replace')
+        return line.replace(b'\\', b'\\\\').replace(
+            b'(', b'\\('
+        ).replace(b')', b'\\)')
+
+    def page_content(self, lines):
+        top = self.page_size[1] - self.margin
+        content = b'BT /F1 %d Tf %d TL %d %d Td\n' % (
+            self.font_size, self.leading, self.margin, top
+        ) + b''.join(
+            b'(' + self.escape(line) + b') Tj T*\n' for line in lines
+        ) + b'ET'
+        return (
+            b'<< /Length %d >>\nstream\n' % len(content)
+            + content + b'\nendstream'
+        )
+
+    def page_tree(self):
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in self.pages)
+        return b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            kids, len(self.pages)
+        )
+
+    def trailer(self):
+        xref_offset = self.offset
+        size = self.last_id + 1
+        return (
+            b'xref\n0 %d\n0000000000 65535 f \n' % size
+            + b''.join(
+                b'%010d 00000 n \n' % self.offsets[object_id]
+                for object_id in range(1, size)
+            )
+            + b'trailer\n<< /Size %d /Root 1 0 R >>\n' % size
+            + b'startxref\n%d\n%%%%EOF\n' % xref_offset
+        )
@@ -0,0 +1,389 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from threading import Lock
+
+from django.conf import settings
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVector
+)
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import (
+    Case, F, IntegerField, OuterRef, Subquery, TextField, Value, When
+)
+from django.db.models.functions import Coalesce
+from django.utils.module_loading import import_string
+
+from recipes.models import (
+    DataVersion, Ingredient, Recipe, RecipeIngredients
+)
+
+DEFAULTS = {
+    'BACKEND': 'api.search.DatabaseIngredientSearch',
+    'LIMIT': 50,
+    'TRIGRAM': False,
+    'TRIGRAM_THRESHOLD': 0.3,
+}
+RECIPE_DEFAULTS = {
+    'BACKEND': 'api.search.PostgresRecipeSearch',
+    'CONFIG': 'russian',
+    'LIMIT': 1000,
+    'BATCH_SIZE': 1000,
+}
+WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2}
+
+Snapshot = namedtuple('Snapshot', ('terms', 'postings', 'documents'))
+
+_backend = None
+_recipe_backend = None
+
+
+def get_search_settings():
+    return {**DEFAULTS, **getattr(settings, 'INGREDIENT_SEARCH', {})}
+
+
+def get_ingredient_search():
+    global _backend
+    if _backend is None:
+        options = get_search_settings()
+        _backend = import_string(options['BACKEND'])(options)
+    return _backend
+
+
+def get_recipe_search_settings():
+    return {**RECIPE_DEFAULTS, **getattr(settings, 'RECIPE_SEARCH', {})}
+
+
+def get_recipe_search():
+    global _recipe_backend
+    if _recipe_backend is None:
+        options = get_recipe_search_settings()
+        _recipe_backend = import_string(options['BACKEND'])(options)
+    return _recipe_backend
+
+
+def tokenize(value):
+    return re.findall(r'\w+', value.casefold())
+
+
+def order_by_ids(queryset, ids):
+    return queryset.filter(pk__in=ids).order_by(Case(
+        *[When(pk=pk, then=position) for position, pk in enumerate(ids)],
+        output_field=IntegerField()
+    ))
+
+
+def trigrams(value):
+    value = f'  {value} '
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class IngredientSearch:
+    def __init__(self, options):
+        self.limit = options['LIMIT']
+        self.trigram = options['TRIGRAM']
+        self.threshold = options['TRIGRAM_THRESHOLD']
+
+    def search(self, queryset, query):
+        query = query.casefold()
+        if not query:
+            return queryset
+        return order_by_ids(queryset, self.search_ids(queryset, query))
+
+    def search_ids(self, queryset, query):
+        raise NotImplementedError
+
+
+class DatabaseIngredientSearch(IngredientSearch):
+    def __init__(self, options):
+        super().__init__(options)
+        if self.trigram and connection.vendor != 'postgresql':
+            raise ImproperlyConfigured(
+                'Поиск ингредиентов по триграммам в базе работает только '
+                'с PostgreSQL'
+            )
+
+    def search_ids(self, queryset, query):
+        ids = list(queryset.filter(
+            search_name__startswith=query
+        ).order_by('search_name', 'pk').values_list('pk', flat=True)[
+            :self.limit
+        ])
+        if self.limit is not None and len(ids) >= self.limit:
+            return ids
+        lookup = 'trigram_similar' if self.trigram else 'contains'
+        fallback = queryset.filter(
+            **{f'search_name__{lookup}': query}
+        ).exclude(
+            search_name__startswith=query
+        ).order_by('search_name', 'pk').values_list('pk', flat=True)
+        if self.limit is not None:
+            fallback = fallback[:self.limit - len(ids)]
+        return ids + list(fallback)
+
+
+class InMemoryIngredientSearch(IngredientSearch):
+    def __init__(self, options):
+        super().__init__(options)
+        self.version = None
+        self.names = None
+        self.ids = None
+        self.trigrams = None
+
+    def build(self, version):
+        rows = sorted(
+            (name.casefold(), pk)
+            for pk, name in Ingredient.objects.values_list('pk', 'name')
+        )
+        self.names = [name for name, _ in rows]
+        self.ids = [pk for _, pk in rows]
+        self.trigrams = [trigrams(name) for name in self.names]
+        self.version = version
+
+    def search_ids(self, queryset, query):
+        version = DataVersion.objects.get_version('ingredients')
+        if version != self.version:
+            self.build(version)
+        ids = self.prefix_ids(query)
+        if self.limit is not None and len(ids) >= self.limit:
+            return ids[:self.limit]
+        ids += self.substring_ids(query)
+        if self.trigram:
+            ids += self.trigram_ids(query, set(ids))
+        return ids[:self.limit]
+
+    def prefix_ids(self, query):
+        ids = []
+        position = bisect_left(self.names, query)
+        while (
+            position < len(self.names)
+            and self.names[position].startswith(query)
+            and (self.limit is None or len(ids) < self.limit)
+        ):
+            ids.append(self.ids[position])
+            position += 1
+        return ids
+
+    def substring_ids(self, query):
+        return [
+            pk for _, _, pk in sorted(
+                (name.find(query), name, pk)
+                for name, pk in zip(self.names, self.ids)
+                if name.find(query) > 0
+            )
+        ]
+
+    def trigram_ids(self, query, found):
+        query_trigrams = trigrams(query)
+        scored = []
+        for name, pk, name_trigrams in zip(
+            self.names, self.ids, self.trigrams
+        ):
+            if pk in found:
+                continue
+            similarity = len(query_trigrams & name_trigrams) / len(
+                query_trigrams | name_trigrams
+            )
+            if similarity >= self.threshold:
+                scored.append((-similarity, name, pk))
+        return [pk for _, _, pk in sorted(scored)]
+
+
+class RecipeSearch:
+    def __init__(self, options):
+        self.config = options['CONFIG']
+        self.limit = options['LIMIT']
+        self.batch_size = options['BATCH_SIZE']
+
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+    def index(self, recipes):
+        raise NotImplementedError
+
+    def remove(self, ids):
+        pass
+
+
+class PostgresRecipeSearch(RecipeSearch):
+    def vector(self):
+        from django.contrib.postgres.aggregates import StringAgg
+
+        ingredients = RecipeIngredients.objects.filter(
+            recipe=OuterRef('pk')
+        ).order_by().values('recipe').annotate(
+            names=StringAgg('ingredient__name', ' ')
+        ).values('names')
+        return (
+            SearchVector('name', weight='A', config=self.config)
+            + SearchVector('description', weight='B', config=self.config)
+            + SearchVector(
+                Coalesce(
+                    Subquery(ingredients, output_field=TextField()), Value('')
+                ),
+                weight='C',
+                config=self.config
+            )
+        )
+
+    def search(self, queryset, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return queryset
+        query = SearchQuery(
+            ' & '.join(f'{token}:*' for token in tokens),
+            search_type='raw',
+            config=self.config
+        )
+        return queryset.filter(search_vector=query).annotate(
+            rank=SearchRank(F('search_vector'), query)
+        ).order_by('-rank', '-pub_date', '-id')
+
+    def index(self, recipes):
+        ids = list(recipes.values_list('pk', flat=True))
+        for start in range(0, len(ids), self.batch_size):
+            Recipe.objects.filter(
+                pk__in=ids[start:start + self.batch_size]
+            ).update(search_vector=self.vector())
+
+
+class InMemoryRecipeSearch(RecipeSearch):
+    # Каждая запись в индекс оставляет в кеше список изменённых рецептов
+    # под новой версией; отставший процесс догоняет по этим спискам, а
+    # если какого-то нет - перестраивает индекс целиком.
+    log_prefix = 'recipe_search:changes'
+    log_timeout = 60 * 60
+    max_log_span = 100
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.version = None
+        self.snapshot = Snapshot([], {}, {})
+        self.lock = Lock()
+
+    def documents(self, ids=None):
+        recipes = Recipe.objects.all()
+        rows = RecipeIngredients.objects.all()
+        if ids is not None:
+            recipes = recipes.filter(pk__in=ids)
+            rows = rows.filter(recipe__in=ids)
+        documents = defaultdict(lambda: defaultdict(float))
+        fields = (('name', 'A'), ('description', 'B'))
+        for recipe in recipes.values('pk', 'name', 'description'):
+            document = documents[recipe['pk']]
+            for field, weight in fields:
+                for token in tokenize(recipe[field]):
+                    document[token] += WEIGHTS[weight]
+        for recipe_id, name in rows.values_list(
+            'recipe_id', 'ingredient__name'
+        ):
+            for token in tokenize(name):
+                documents[recipe_id][token] += WEIGHTS['C']
+        return {pk: dict(document) for pk, document in documents.items()}
+
+    def build(self, version):
+        documents = self.documents()
+        postings = defaultdict(dict)
+        for pk, document in documents.items():
+            for term, score in document.items():
+                postings[term][pk] = score
+        self.snapshot = Snapshot(sorted(postings), dict(postings), documents)
+        self.version = version
+
+    def update(self, ids):
+        # Снимок не меняется на месте: поиск в других потоках читает
+        # прежний, пока собирается новый.
+        terms, postings, documents = self.snapshot
+        postings = dict(postings)
+        documents = dict(documents)
+        fresh = self.documents(ids)
+        touched = {}
+        for pk in ids:
+            for term in documents.pop(pk, {}):
+                touched.setdefault(term, dict(postings.get(term, {})))
+                touched[term].pop(pk, None)
+            for term, score in fresh.get(pk, {}).items():
+                touched.setdefault(term, dict(postings.get(term, {})))
+                touched[term][pk] = score
+            if pk in fresh:
+                documents[pk] = fresh[pk]
+        added = {term for term in touched if term not in postings}
+        for term, ids_scores in touched.items():
+            if ids_scores:
+                postings[term] = ids_scores
+            else:
+                postings.pop(term, None)
+        removed = {term for term in touched if term not in postings}
+        if added or removed:
+            terms = sorted((set(terms) - removed) | added)
+        self.snapshot = Snapshot(terms, postings, documents)
+
+    def log_key(self, version):
+        return f'{self.log_prefix}:{version}'
+
+    def refresh(self, version):
+        with self.lock:
+            if version == self.version:
+                return
+            span = (
+                version - self.version if self.version is not None else 0
+            )
+            if 0 < span <= self.max_log_span:
+                logs = cache.get_many([
+                    self.log_key(self.version + offset)
+                    for offset in range(1, span + 1)
+                ])
+                if len(logs) == span:
+                    self.update(set().union(*logs.values()))
+                    self.version = version
+                    return
+            self.build(version)
+
+    def matches(self, snapshot, token):
+        terms, postings, _ = snapshot
+        scores = defaultdict(float)
+        position = bisect_left(terms, token)
+        while position < len(terms) and terms[position].startswith(token):
+            for pk, score in postings[terms[position]].items():
+                scores[pk] += score
+            position += 1
+        return scores
+
+    def search(self, queryset, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return queryset
+        version = DataVersion.objects.get_version('recipe_search')
+        if version != self.version:
+            self.refresh(version)
+        snapshot = self.snapshot
+        scores = None
+        for token in tokens:
+            found = self.matches(snapshot, token)
+            if scores is None:
+                scores = found
+                continue
+            scores = {
+                pk: score + found[pk]
+                for pk, score in scores.items() if pk in found
+            }
+        ranked = sorted(scores, key=lambda pk: (-scores[pk], -pk))
+        return order_by_ids(queryset, ranked[:self.limit])
+
+    def index(self, recipes):
+        self.changed(set(recipes.values_list('pk', flat=True)))
+
+    def remove(self, ids):
+        self.changed(set(ids))
+
+    def changed(self, ids):
+        with transaction.atomic():
+            DataVersion.objects.bump('recipe_search')
+            version = DataVersion.objects.get_version('recipe_search')
+        cache.set(self.log_key(version), ids, self.log_timeout)
+        with self.lock:
+            if self.version == version - 1:
+                self.update(ids)
+                self.version = version
@@ -5,16 +5,19 @@ from rest_framework.exceptions import ValidationError
 from rest_framework.fields import (
     CharField, IntegerField, SerializerMethodField,
     CurrentUserDefault, HiddenField)
-from rest_framework.relations import PrimaryKeyRelatedField
 from rest_framework.serializers import ModelSerializer
 from rest_framework.validators import UniqueTogetherValidator
 
 from users.models import Subscription
 from recipes.models import (
     Ingredient, Recipe, RecipeIngredients, Tag,
-    ShopCart, FavoriteRecipes)
+    ShopCart, ShopCartIngredient, FavoriteRecipes)
 
-from .fields import Base64ImageField
+from .fields import (
+    Base64ImageField, ContextAuthorDefault, PrimaryKeyListField,
+    RecipeImageField, StoredImageField
+)
+from .signals import rebuild_vectors
 
 User = get_user_model()
 
@@ -58,7 +61,7 @@ class RecipeIngredientsCreateSerializer(ModelSerializer):
 
 
 class RecipeShortSerializer(ModelSerializer):
-    image = Base64ImageField()
+    image = RecipeImageField(width=160)
 
     class Meta:
         model = Recipe
@@ -66,6 +69,16 @@ class RecipeShortSerializer(ModelSerializer):
         read_only_fields = ('__all__',)
 
 
+class SimilarRecipeSerializer(RecipeShortSerializer):
+    similarity = SerializerMethodField()
+
+    class Meta(RecipeShortSerializer.Meta):
+        fields = RecipeShortSerializer.Meta.fields + ('similarity',)
+
+    def get_similarity(self, obj):
+        return round(self.context['similarity'][obj.pk], 4)
+
+
 class CustomUserCreateSerializer(UserCreateSerializer):
     password = CharField(style={'input_type': 'password'}, write_only=True)
 
@@ -98,10 +111,13 @@ class CustomUserSerializer(UserSerializer):
         fields = (
             'email', 'id', 'username',
             'first_name', 'last_name',
-            'is_subscribed'
+            'is_subscribed', 'recipes_count', 'subscribers_count'
         )
+        read_only_fields = ('recipes_count', 'subscribers_count')
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context.get('request').user
         if not user.is_authenticated:
             return False
@@ -137,33 +153,36 @@ class SubscriptionCreateSerializer(ModelSerializer):
 
 class SubscriptionSerializer(CustomUserSerializer):
     recipes = SerializerMethodField()
-    recipes_count = SerializerMethodField()
 
     class Meta:
         model = User
         fields = (
             'email', 'id', 'username',
             'first_name', 'last_name', 'is_subscribed',
-            'recipes', 'recipes_count'
+            'recipes', 'recipes_count', 'subscribers_count'
         )
         read_only_fields = ('__all__',)
 
     def get_recipes(self, obj):
+        if hasattr(obj, 'recipes_preview'):
+            return RecipeShortSerializer(obj.recipes_preview, many=True).data
         recipes = obj.recipes.all()
+        limit = self.context.get(
+            'request'
+        ).query_params.get('recipes_limit')
+        if not limit:
+            return RecipeShortSerializer(recipes, many=True).data
         try:
-            limit = self.context.get(
-                'request'
-            ).query_params.get('recipes_limit')
-            if limit:
-                recipes = recipes[:int(limit)]
+            limit = int(limit)
         except ValueError:
             raise ValidationError(
                 'recipes_limit должен быть числом'
             )
-        return RecipeShortSerializer(recipes, many=True).data
-
-    def get_recipes_count(self, obj):
-        return obj.recipes.count()
+        if limit < 0:
+            raise ValidationError(
+                'recipes_limit не может быть отрицательным'
+            )
+        return RecipeShortSerializer(recipes[:limit], many=True).data
 
 
 class ShopCartSerializer(ModelSerializer):
@@ -186,6 +205,12 @@ class ShopCartSerializer(ModelSerializer):
             raise ValidationError('Такого рецепта не существует')
         return value
 
+    @transaction.atomic
+    def create(self, validated_data):
+        cart = super().create(validated_data)
+        ShopCartIngredient.objects.add_recipe([cart.user_id], cart.recipe)
+        return cart
+
 
 class FavoriteRecipeSerializer(ModelSerializer):
     user = HiddenField(default=CurrentUserDefault())
@@ -217,7 +242,7 @@ class RecipeSerializer(ModelSerializer):
     )
     is_favorited = SerializerMethodField()
     is_in_shopping_cart = SerializerMethodField()
-    image = Base64ImageField()
+    image = RecipeImageField()
     text = CharField(source='description')
 
     class Meta:
@@ -225,26 +250,57 @@ class RecipeSerializer(ModelSerializer):
         fields = (
             'id', 'tags', 'author', 'ingredients',
             'is_favorited', 'is_in_shopping_cart',
-            'name', 'image', 'text', 'cooking_time'
+            'name', 'image', 'text', 'cooking_time',
+            'favorites_count', 'cart_count'
         )
         read_only_fields = ('__all__',)
 
-    def get_is_favorited(self, obj):
+    def get_user_flag(self, obj, flag, related_name):
+        if hasattr(obj, flag):
+            return getattr(obj, flag)
         user = self.context.get('request').user
         if not user.is_authenticated:
             return False
-        return obj.in_favorite.filter(user=user).exists()
+        return getattr(obj, related_name).filter(user=user).exists()
+
+    def get_is_favorited(self, obj):
+        return self.get_user_flag(obj, 'is_favorited', 'in_favorite')
 
     def get_is_in_shopping_cart(self, obj):
-        user = self.context.get('request').user
-        if not user.is_authenticated:
-            return False
-        return obj.in_shopping_cart.filter(user=user).exists()
+        return self.get_user_flag(
+            obj, 'is_in_shopping_cart', 'in_shopping_cart'
+        )
+
+
+class CookableRecipeSerializer(RecipeSerializer):
+    matched_ingredients = SerializerMethodField()
+    total_ingredients = SerializerMethodField()
+    coverage = SerializerMethodField()
+
+    class Meta(RecipeSerializer.Meta):
+        fields = RecipeSerializer.Meta.fields + (
+            'matched_ingredients', 'total_ingredients', 'coverage'
+        )
+
+    def get_matched_ingredients(self, obj):
+        return self.context['matches'][obj.pk][0]
+
+    def get_total_ingredients(self, obj):
+        return self.context['matches'][obj.pk][1]
+
+    def get_coverage(self, obj):
+        matched, total = self.context['matches'][obj.pk]
+        return round(matched / total, 4)
 
 
 class RecipeCreateSerializer(ModelSerializer):
-    tags = PrimaryKeyRelatedField(
-        queryset=Tag.objects.all(), many=True
+    tags = PrimaryKeyListField(
+        queryset=Tag.objects.all(),
+        error_messages={
+            'empty': 'Добавьте теги',
+            'duplicate': 'Добавлен повторяющийся тег',
+            'does_not_exist': 'Добавлен несуществующий тег',
+        }
     )
     author = HiddenField(default=CurrentUserDefault())
     ingredients = RecipeIngredientsCreateSerializer(
@@ -275,35 +331,25 @@ class RecipeCreateSerializer(ModelSerializer):
             raise ValidationError('Время приготовления должно быть больше 1')
         return value
 
-    def validate_tags(self, value):
-        if not value:
-            raise ValidationError('Добавьте теги')
-        len_value = len(value)
-        if len_value > len(set(value)):
-            raise ValidationError('Добавлен повторяющийся тег')
-        if len_value != Tag.objects.filter(
-                id__in=[val.id for val in value]
-        ).count():
-            raise ValidationError('Добавлен несуществующий тег')
-        return value
-
     def validate_ingredients(self, value):
-        ingredients_ids = []
-        for ingredient in value:
-            id = ingredient.get('ingredient', {}).get('id')
-            if id not in ingredients_ids:
-                ingredients_ids.append(id)
-            else:
-                raise ValidationError('Добавлен повторяющийся ингредиент')
-
-        if len(value) != Ingredient.objects.filter(
-            id__in=ingredients_ids
-        ).count():
-            raise ValidationError('Добавлен несуществующий ингредиент')
-
-        if not ingredients_ids:
+        if not value:
             raise ValidationError('Добавьте ингредиенты')
-
+        ids = [ingredient['ingredient']['id'] for ingredient in value]
+        existing = self.context.get('preloaded', {}).get('ingredients')
+        if existing is None:
+            existing = set(Ingredient.objects.filter(
+                id__in=ids
+            ).values_list('id', flat=True))
+        errors = {}
+        seen = set()
+        for index, id in enumerate(ids):
+            if id in seen:
+                errors[index] = ['Добавлен повторяющийся ингредиент']
+            elif id not in existing:
+                errors[index] = ['Добавлен несуществующий ингредиент']
+            seen.add(id)
+        if errors:
+            raise ValidationError(errors)
         return value
 
     @transaction.atomic
@@ -324,26 +370,73 @@ class RecipeCreateSerializer(ModelSerializer):
         recipe = super().create(validated_data)
         recipe.tags.set(tags)
         self.create_ingredients(recipe, ingredients)
+        rebuild_vectors((recipe.pk,))
 
         return recipe
 
+    def update_tags(self, instance, tags):
+        current = set(instance.tags.values_list('pk', flat=True))
+        new = {tag.pk for tag in tags}
+        if current - new:
+            instance.tags.remove(*(current - new))
+        if new - current:
+            instance.tags.add(*(new - current))
+        return len(current ^ new)
+
+    def update_ingredients(self, instance, ingredients):
+        amounts = {
+            ingredient['ingredient']['id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        old_amounts, changed = RecipeIngredients.objects.sync(
+            instance, amounts
+        )
+        if changed:
+            ShopCartIngredient.objects.change_recipe(
+                instance, old_amounts, amounts
+            )
+        return changed
+
     @transaction.atomic
     def update(self, instance, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
 
+        changed_rows = {'tags': 0, 'ingredients': 0}
         if tags:
-            instance.tags.clear()
-            instance.tags.set(tags)
-
+            changed_rows['tags'] = self.update_tags(instance, tags)
         if ingredients:
-            RecipeIngredients.objects.filter(recipe=instance).delete()
-            self.create_ingredients(instance, ingredients)
+            changed_rows['ingredients'] = self.update_ingredients(
+                instance, ingredients
+            )
+        if any(changed_rows.values()):
+            rebuild_vectors((instance.pk,))
+        changed_rows['search'] = changed_rows['ingredients'] + sum(
+            validated_data.get(field, value) != value
+            for field, value in (
+                ('name', instance.name),
+                ('description', instance.description)
+            )
+        )
+        # Сигналы сохранения рецепта по этим счётчикам сбрасывают только
+        # то, что изменилось.
+        instance._changed_rows = changed_rows
+        recipe = super().update(instance, validated_data)
+        del instance._changed_rows
 
-        return super().update(instance, validated_data)
+        return recipe
 
     def to_representation(self, instance):
         request = self.context.get('request')
         context = {'request': request}
+        if request is not None:
+            instance = Recipe.objects.with_user_flags(
+                request.user
+            ).with_related(request.user).get(pk=instance.pk)
         return RecipeSerializer(
             instance, context=context).data
+
+
+class RecipeImportSerializer(RecipeCreateSerializer):
+    author = HiddenField(default=ContextAuthorDefault())
+    image = StoredImageField(Recipe._meta.get_field('image').storage)
@@ -0,0 +1,232 @@
+from threading import local
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_delete, pre_save
+)
+from django.dispatch import receiver
+
+from recipes.images import schedule_renditions
+from recipes.models import (
+    DataVersion, Ingredient, MediaFile, Recipe, RecipeImageRendition,
+    RecipeIngredients, RecipeScore, RecipeVector, Tag
+)
+from .cache import response_cache
+from .search import get_recipe_search
+
+User = get_user_model()
+_pending = local()
+
+
+def invalidate(dependencies):
+    dependencies = set(dependencies)
+    transaction.on_commit(lambda: response_cache.invalidate(dependencies))
+
+
+def bump_versions(*names):
+    def bump():
+        for name in names:
+            DataVersion.objects.bump(name)
+    transaction.on_commit(bump)
+
+
+def index_recipes(recipes):
+    transaction.on_commit(lambda: get_recipe_search().index(recipes))
+
+
+class VectorRebuild:
+    def __init__(self):
+        self.ids = set()
+
+    def __call__(self):
+        RecipeVector.objects.rebuild(sorted(self.ids))
+
+
+def rebuild_vectors(recipe_ids):
+    # Все изменения ингредиентов и тегов в одной транзакции пересчитывают
+    # векторы одним вызовом после коммита.
+    callback = getattr(_pending, 'vectors', None)
+    scheduled = callback is not None and any(
+        func is callback
+        for _, func in transaction.get_connection().run_on_commit
+    )
+    if not scheduled:
+        callback = _pending.vectors = VectorRebuild()
+    callback.ids.update(recipe_ids)
+    if not scheduled:
+        transaction.on_commit(callback)
+
+
+def recipe_dependencies(recipe):
+    yield 'recipes'
+    yield 'recipes:search'
+    yield f'recipe:{recipe.pk}'
+    yield f'recipes:author:{recipe.author_id}'
+    for slug in recipe.tags.values_list('slug', flat=True):
+        yield f'recipes:tag:{slug}'
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def bump_tags_version(sender, instance, **kwargs):
+    DataVersion.objects.bump('tags')
+    invalidate((f'tag:{instance.pk}', f'recipes:tag:{instance.slug}'))
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def bump_ingredients_version(sender, instance, **kwargs):
+    DataVersion.objects.bump('ingredients')
+    invalidate((f'ingredient:{instance.pk}', 'recipes:search'))
+
+
+@receiver(post_save, sender=Ingredient)
+def index_ingredient_recipes(sender, instance, created, **kwargs):
+    if not created:
+        index_recipes(Recipe.objects.filter(ingredients=instance.pk))
+
+
+@receiver(post_save, sender=Recipe)
+def index_recipe(sender, instance, **kwargs):
+    changed_rows = getattr(instance, '_changed_rows', None)
+    if changed_rows is not None and not changed_rows['search']:
+        return
+    index_recipes(Recipe.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Recipe)
+def unindex_recipe(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: get_recipe_search().remove((pk,)))
+
+
+@receiver(post_delete, sender=Recipe)
+def drop_recipe_vector(sender, instance, **kwargs):
+    # Вектор удаляется каскадом вместе с рецептом.
+    bump_versions('recipe_vectors')
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(pre_delete, sender=Recipe)
+def invalidate_recipe(sender, instance, created=False, **kwargs):
+    changed_rows = getattr(instance, '_changed_rows', None)
+    if created or changed_rows is None:
+        invalidate(recipe_dependencies(instance))
+        return
+    # Правка через API не меняет автора и порядок рецептов, а страницы
+    # добавленных тегов сбрасывает m2m_changed.
+    dependencies = {f'recipe:{instance.pk}'}
+    if changed_rows['search']:
+        dependencies.add('recipes:search')
+    invalidate(dependencies)
+
+
+@receiver(post_save, sender=Recipe)
+def generate_recipe_renditions(sender, instance, **kwargs):
+    if instance.image and not instance.renditions.filter(
+        source=instance.image.name
+    ).exists():
+        schedule_renditions(instance.pk)
+
+
+@receiver(post_save, sender=Recipe)
+def create_recipe_score(sender, instance, created, **kwargs):
+    if created:
+        RecipeScore.objects.get_or_create(recipe=instance)
+
+
+@receiver(pre_save, sender=Recipe)
+def remember_recipe_image(sender, instance, **kwargs):
+    instance._stored_image = Recipe.objects.filter(
+        pk=instance.pk
+    ).values_list('image', flat=True).first()
+
+
+@receiver(post_save, sender=Recipe)
+def count_recipe_image(sender, instance, **kwargs):
+    stored = getattr(instance, '_stored_image', None)
+    if stored != instance.image.name:
+        MediaFile.objects.release((stored,))
+        MediaFile.objects.acquire((instance.image.name,))
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=RecipeImageRendition)
+def release_image(sender, instance, **kwargs):
+    MediaFile.objects.release((instance.image.name,))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        recipes = Recipe.objects.filter(pk__in=pk_set or ())
+        if action == 'pre_clear':
+            recipes = instance.recipes.all()
+        invalidate((
+            'recipes', f'recipes:tag:{instance.slug}',
+            *(f'recipe:{pk}' for pk in recipes.values_list('pk', flat=True))
+        ))
+        return
+    tags = Tag.objects.filter(pk__in=pk_set or ())
+    if action == 'pre_clear':
+        tags = instance.tags.all()
+    invalidate((
+        'recipes', f'recipe:{instance.pk}',
+        *(f'recipes:tag:{slug}' for slug in tags.values_list(
+            'slug', flat=True
+        ))
+    ))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def update_recipe_tags_mask(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    if reverse and action == 'pre_clear':
+        instance._cleared_recipes = list(
+            instance.recipes.values_list('pk', flat=True)
+        )
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        Recipe.objects.filter(pk=instance.pk).refresh_tags_mask()
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_recipes', ())
+    Recipe.objects.filter(pk__in=pk_set or ()).refresh_tags_mask()
+
+
+@receiver(post_save, sender=RecipeIngredients)
+@receiver(post_delete, sender=RecipeIngredients)
+def invalidate_recipe_ingredients(sender, instance, **kwargs):
+    invalidate((f'recipe:{instance.recipe_id}',))
+    index_recipes(Recipe.objects.filter(pk=instance.recipe_id))
+    rebuild_vectors((instance.recipe_id,))
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def rebuild_recipe_tag_vectors(sender, instance, action, reverse, pk_set,
+                               **kwargs):
+    if reverse and action == 'pre_clear':
+        rebuild_vectors(instance.recipes.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        rebuild_vectors((instance.pk,))
+    elif pk_set:
+        rebuild_vectors(pk_set)
+
+
+@receiver(pre_delete, sender=Tag)
+def rebuild_tag_vectors(sender, instance, **kwargs):
+    # Строки связи удаляются каскадом без m2m_changed.
+    rebuild_vectors(instance.recipes.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    invalidate((f'user:{instance.pk}',))
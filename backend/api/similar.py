@@ -0,0 +1,263 @@
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import timedelta
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from recipes.models import DataVersion, RecipeVector
+
+DEFAULTS = {
+    'TAG_WEIGHT': 0.5,
+    'MAX_LIMIT': 100,
+    'CACHE_SIZE': 10000,
+    'OVERLAP': timedelta(minutes=5),
+    'REBUILD_RATIO': 0.1,
+}
+
+_index = None
+
+# Снимок индекса не меняется после построения: обновление собирает новый
+# снимок, разделяя со старым всё, что не затронуто.
+Snapshot = namedtuple('Snapshot', (
+    'ids', 'slots', 'features', 'postings', 'idf', 'norms', 'documents',
+    'changes'
+))
+EMPTY = np.empty(0, dtype=np.int64)
+
+
+def get_similar_settings():
+    return {**DEFAULTS, **getattr(settings, 'RECIPE_SIMILAR', {})}
+
+
+def get_similarity_index():
+    global _index
+    if _index is None:
+        _index = RecipeSimilarityIndex(get_similar_settings())
+    return _index
+
+
+def unpack_ids(value):
+    return np.frombuffer(bytes(value), dtype=np.uint32).astype(np.int64)
+
+
+def encode(value):
+    # Ингредиенты и теги делят одно пространство признаков.
+    ingredients, tags = value
+    return np.concatenate(
+        (unpack_ids(ingredients) * 2, unpack_ids(tags) * 2 + 1)
+    )
+
+
+class RecipeSimilarityIndex:
+    def __init__(self, options):
+        self.tag_weight = options['TAG_WEIGHT']
+        self.max_limit = options['MAX_LIMIT']
+        self.cache_size = options['CACHE_SIZE']
+        self.overlap = options['OVERLAP']
+        self.rebuild_ratio = options['REBUILD_RATIO']
+        self.version = None
+        self.loaded = None
+        self.snapshot = self.build({})
+        self.cache = OrderedDict()
+        self.lock = Lock()
+
+    def weight(self, feature, documents, frequency):
+        idf = np.log((1 + documents) / (1 + frequency)) + 1
+        return idf * (self.tag_weight if feature % 2 else 1.0)
+
+    def build(self, vectors):
+        ids = np.array(sorted(vectors), dtype=np.int64)
+        features = {pk: encode(vectors[pk]) for pk in ids.tolist()}
+        lengths = np.array(
+            [len(features[pk]) for pk in ids.tolist()], dtype=np.int64
+        )
+        keys = (
+            np.concatenate(list(features.values())) if features else EMPTY
+        )
+        columns, inverse = np.unique(keys, return_inverse=True)
+        rows = np.repeat(np.arange(len(ids)), lengths)
+        frequency = np.bincount(inverse, minlength=len(columns))
+        idf = np.log((1 + len(ids)) / (1 + frequency)) + 1
+        idf *= np.where(columns % 2, self.tag_weight, 1.0)
+        order = np.argsort(inverse, kind='stable')
+        column_ptr = np.searchsorted(
+            inverse[order], np.arange(len(columns) + 1)
+        )
+        column_rows = rows[order]
+        return Snapshot(
+            ids=ids,
+            slots={pk: slot for slot, pk in enumerate(ids.tolist())},
+            features=features,
+            postings={
+                feature: column_rows[column_ptr[index]:column_ptr[index + 1]]
+                for index, feature in enumerate(columns.tolist())
+            },
+            idf=dict(zip(columns.tolist(), idf.tolist())),
+            norms=np.sqrt(np.bincount(
+                rows, idf[inverse] ** 2, minlength=len(ids)
+            )),
+            documents=len(ids),
+            changes=0,
+        )
+
+    def apply(self, snapshot, vectors, deleted):
+        # IDF заморожен до следующей полной сборки, поэтому изменение
+        # рецепта пересчитывает только его строку и затронутые списки.
+        slots = dict(snapshot.slots)
+        features = dict(snapshot.features)
+        postings = dict(snapshot.postings)
+        idf = dict(snapshot.idf)
+        created = [pk for pk in vectors if pk not in slots]
+        ids = np.concatenate((snapshot.ids, np.array(created, np.int64)))
+        norms = np.concatenate((snapshot.norms, np.zeros(len(created))))
+        slots.update(
+            (pk, len(snapshot.ids) + offset)
+            for offset, pk in enumerate(created)
+        )
+        removed = defaultdict(list)
+        added = defaultdict(list)
+        for pk in deleted:
+            slot = slots.pop(pk)
+            for feature in features.pop(pk).tolist():
+                removed[feature].append(slot)
+            norms[slot] = 0
+        for pk, value in vectors.items():
+            old = features.get(pk, EMPTY)
+            new = encode(value)
+            for feature in np.setdiff1d(old, new).tolist():
+                removed[feature].append(slots[pk])
+            for feature in np.setdiff1d(new, old).tolist():
+                added[feature].append(slots[pk])
+            features[pk] = new
+        for feature in removed.keys() | added.keys():
+            rows = postings.get(feature, EMPTY)
+            rows = np.concatenate((
+                rows[~np.isin(rows, removed[feature])],
+                np.array(added[feature], dtype=np.int64)
+            ))
+            if len(rows):
+                postings[feature] = rows
+            else:
+                postings.pop(feature, None)
+            if feature not in idf:
+                idf[feature] = self.weight(
+                    feature, snapshot.documents, len(rows)
+                )
+        for pk in vectors:
+            norms[slots[pk]] = np.sqrt(sum(
+                idf[feature] ** 2 for feature in features[pk].tolist()
+            ))
+        return snapshot._replace(
+            ids=ids, slots=slots, features=features, postings=postings,
+            idf=idf, norms=norms,
+            changes=snapshot.changes + len(vectors) + len(deleted)
+        )
+
+    def refresh(self):
+        version = DataVersion.objects.get_version('recipe_vectors')
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            started = timezone.now()
+            since = None if self.loaded is None else self.loaded - self.overlap
+            snapshot = self.snapshot
+            vectors, deleted = RecipeVector.objects.changes(
+                since, snapshot.slots
+            )
+            if since is not None:
+                vectors = {
+                    pk: value for pk, value in vectors.items()
+                    if pk not in snapshot.features or not np.array_equal(
+                        snapshot.features[pk], encode(value)
+                    )
+                }
+            if since is None or (
+                snapshot.changes + len(vectors) + len(deleted)
+                > self.rebuild_ratio * max(snapshot.documents, 1)
+            ):
+                if since is not None:
+                    vectors, _ = RecipeVector.objects.changes(None, {})
+                self.snapshot = self.build(vectors)
+                self.cache = OrderedDict()
+            elif vectors or deleted:
+                self.snapshot = self.apply(snapshot, vectors, deleted)
+                self.invalidate(self.snapshot, vectors, deleted)
+            self.loaded = started
+            self.version = version
+
+    def invalidate(self, snapshot, vectors, deleted):
+        # Сбрасываем только списки, в которые изменённый рецепт входил
+        # или теперь может войти.
+        changed = set(vectors) | deleted
+        scores = {
+            snapshot.slots[pk]: self.scores(snapshot, snapshot.slots[pk])
+            for pk in vectors
+        }
+        for pk, (result, members) in list(self.cache.items()):
+            if pk in changed or members & changed:
+                del self.cache[pk]
+                continue
+            slot = snapshot.slots.get(pk)
+            if slot is None or any(
+                values[slot] > 0 and (
+                    len(result) < self.max_limit
+                    or values[slot] >= result[-1][1]
+                )
+                for values in scores.values()
+            ):
+                del self.cache[pk]
+
+    def scores(self, snapshot, position):
+        features = snapshot.features[int(snapshot.ids[position])].tolist()
+        if not features:
+            return np.zeros(len(snapshot.ids))
+        rows = [snapshot.postings[feature] for feature in features]
+        weights = np.repeat(
+            [snapshot.idf[feature] ** 2 for feature in features],
+            [len(row) for row in rows]
+        )
+        dots = np.bincount(
+            np.concatenate(rows), weights, minlength=len(snapshot.ids)
+        )
+        norms = snapshot.norms * snapshot.norms[position]
+        scores = np.divide(
+            dots, norms, out=np.zeros_like(dots), where=norms > 0
+        )
+        scores[position] = 0
+        return scores
+
+    def neighbours(self, snapshot, pk):
+        position = snapshot.slots.get(pk)
+        if position is None or snapshot.norms[position] == 0:
+            return []
+        scores = self.scores(snapshot, position)
+        ids = snapshot.ids
+        limit = min(self.max_limit, len(ids) - 1)
+        if limit <= 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.lexsort((-ids[top], -scores[top]))]
+        return [
+            (int(ids[row]), float(scores[row]))
+            for row in top if scores[row] > 0
+        ]
+
+    def similar(self, pk, limit):
+        self.refresh()
+        limit = min(limit, self.max_limit)
+        snapshot, cache = self.snapshot, self.cache
+        entry = cache.get(pk)
+        if entry is None:
+            result = self.neighbours(snapshot, pk)
+            entry = (result, {neighbour for neighbour, _ in result})
+            with self.lock:
+                # Снимок мог смениться, пока считали соседей.
+                if self.snapshot is snapshot:
+                    self.cache[pk] = entry
+                    while len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+        return entry[0][:limit]
@@ -0,0 +1,836 @@
+import json
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+from PIL import Image
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from api.bulk import RecipeImporter
+from api.cache import response_cache
+from api.filters import RECIPE_ORDERINGS
+from api.instrumentation import histograms
+from api.matching import RecipeIngredientIndex, get_matching_settings
+from api.paginator import CustomPageNumberPagination
+from api.search import InMemoryRecipeSearch, get_recipe_search_settings
+from api.similar import RecipeSimilarityIndex, get_similar_settings
+from recipes.models import (
+    FavoriteRecipes, ImportCheckpoint, Ingredient, Recipe,
+    RecipeImageRendition, RecipeIngredients, RecipeScore, ShopCart,
+    ShopCartIngredient, Tag
+)
+from users.models import Subscription, User
+
+RECIPES_COUNT = 500
+MEDIA_ROOT = mkdtemp()
+
+
+def tearDownModule():
+    rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+def image_file():
+    buffer = BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, 'PNG')
+    return ContentFile(buffer.getvalue(), name='test.png')
+
+
+class RecipeListQueriesTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(
+            username='viewer', email='viewer@example.com'
+        )
+        authors = [
+            User.objects.create(
+                username=f'author{index}', email=f'author{index}@example.com'
+            )
+            for index in range(5)
+        ]
+        Subscription.objects.create(subscriber=cls.user, author=authors[0])
+        tags = [
+            Tag.objects.create(
+                name=f'Тег {index}', color=f'#00000{index}', slug=f'tag{index}'
+            )
+            for index in range(3)
+        ]
+        ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {index}', measurement_unit='г'
+            )
+            for index in range(10)
+        ]
+        # Строки создаются пачками, без сигналов: тест проверяет только
+        # число запросов на чтение.
+        Recipe.objects.bulk_create(
+            Recipe(
+                author=authors[index % len(authors)],
+                name=f'Рецепт {index}',
+                image='recipe/images/test.png',
+                description='Описание',
+                cooking_time=10
+            )
+            for index in range(RECIPES_COUNT)
+        )
+        recipes = list(Recipe.objects.order_by('pk'))
+        Recipe.tags.through.objects.bulk_create(
+            Recipe.tags.through(recipe=recipe, tag=tag)
+            for index, recipe in enumerate(recipes)
+            for tag in tags[:1 + index % len(tags)]
+        )
+        RecipeIngredients.objects.bulk_create(
+            RecipeIngredients(
+                recipe=recipe,
+                ingredient=ingredients[(index + offset) % len(ingredients)],
+                amount=offset + 1
+            )
+            for index, recipe in enumerate(recipes)
+            for offset in range(3)
+        )
+        FavoriteRecipes.objects.bulk_create(
+            FavoriteRecipes(user=cls.user, recipe=recipe)
+            for recipe in recipes[::2]
+        )
+        ShopCart.objects.bulk_create(
+            ShopCart(user=cls.user, recipe=recipe)
+            for recipe in recipes[::3]
+        )
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_list_queries_do_not_depend_on_page_size(self):
+        # Страница, количество, авторы, теги, варианты изображений и
+        # ингредиенты - по одному запросу при любом размере страницы.
+        for limit in (6, 50, RECIPES_COUNT):
+            with self.subTest(limit=limit):
+                with self.assertNumQueries(6):
+                    response = self.client.get(
+                        '/api/recipes/', {'limit': limit}
+                    )
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), limit)
+
+
+class RecipeListCacheTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        cls.recipe = Recipe.objects.create(
+            author=author,
+            name='Рецепт',
+            image='recipe/images/test.png',
+            description='Описание',
+            cooking_time=10
+        )
+        RecipeImageRendition.objects.create(
+            recipe=cls.recipe,
+            source='recipe/images/test.png',
+            name='small',
+            image_format='jpeg',
+            width=320,
+            height=240,
+            image='recipe/renditions/test-320.jpg'
+        )
+
+    def setUp(self):
+        response_cache.cache.clear()
+
+    def get_image(self, params):
+        response = self.client.get('/api/recipes/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results'][0]['image']
+
+    def test_image_params_are_part_of_cache_key(self):
+        self.assertIn('recipe/images/test.png', self.get_image({}))
+        self.assertIn(
+            'recipe/renditions/test-320.jpg',
+            self.get_image({'image_width': 100})
+        )
+        self.assertIn(
+            'recipe/images/test.png', self.get_image({'image_width': 1000})
+        )
+
+
+class RecipeCursorTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        for index in range(13):
+            Recipe.objects.create(
+                author=author,
+                name=f'Рецепт {index}',
+                image='recipe/images/test.png',
+                description='Описание',
+                cooking_time=10
+            )
+        ids = sorted(Recipe.objects.values_list('pk', flat=True))
+        # Одинаковые даты и рейтинги: порядок внутри группы держит id.
+        published = Recipe.objects.get(pk=ids[0]).pub_date
+        Recipe.objects.filter(pk__in=ids[::2]).update(pub_date=published)
+        RecipeScore.objects.filter(recipe__in=ids[:6]).update(popular=1)
+        Recipe.objects.filter(pk__in=ids[1::3]).update(tags_mask=None)
+
+    def setUp(self):
+        response_cache.cache.clear()
+
+    def get_ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.json()['results']]
+
+    def test_cursor_pages_cover_all_recipes(self):
+        for ordering in ('newest', 'popular'):
+            with self.subTest(ordering=ordering):
+                expected = list(Recipe.objects.annotate(
+                    popularity=F('score__popular')
+                ).order_by(*RECIPE_ORDERINGS[ordering]).values_list(
+                    'pk', flat=True
+                ))
+                response = self.client.get('/api/recipes/', {
+                    'ordering': ordering, 'cursor': '', 'limit': 5
+                })
+                pages = [self.get_ids(response)]
+                while response.json()['next']:
+                    response = self.client.get(response.json()['next'])
+                    pages.append(self.get_ids(response))
+                self.assertEqual([len(page) for page in pages], [5, 5, 3])
+                self.assertEqual(sum(pages, []), expected)
+                response = self.client.get(response.json()['previous'])
+                self.assertEqual(self.get_ids(response), pages[1])
+
+    def test_invalid_cursor_is_not_found(self):
+        for cursor in ('???', 'eyJwIjogWzFdLCAiciI6IGZhbHNlfQ=='):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(
+                    '/api/recipes/', {'cursor': cursor}
+                )
+                self.assertEqual(response.status_code, 404)
+
+    def test_keyset_filter_handles_nulls(self):
+        # NULL в маске тегов бывает у рецептов, созданных в обход модели.
+        paginator = CustomPageNumberPagination()
+        nulls_largest = connection.features.nulls_order_largest
+        for ordering in (('tags_mask', 'id'), ('-tags_mask', '-id')):
+            with self.subTest(ordering=ordering):
+                queryset = Recipe.objects.order_by(*ordering).values_list(
+                    'tags_mask', 'pk'
+                )
+                expected = list(queryset)
+                for index, position in enumerate(expected):
+                    self.assertEqual(
+                        list(queryset.filter(paginator.keyset_filter(
+                            ordering, position, nulls_largest
+                        ))),
+                        expected[index + 1:]
+                    )
+
+
+class ShoppingListTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        cls.user = User.objects.create(
+            username='buyer', email='buyer@example.com'
+        )
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {index}', measurement_unit='г'
+            )
+            for index in range(3)
+        ]
+        cls.recipes = []
+        for name, amounts in (('Суп', (100, 5, 0)), ('Каша', (50, 0, 7))):
+            recipe = Recipe.objects.create(
+                author=cls.author,
+                name=name,
+                image='recipe/images/test.png',
+                description='Описание',
+                cooking_time=10
+            )
+            RecipeIngredients.objects.bulk_create(
+                RecipeIngredients(
+                    recipe=recipe, ingredient=ingredient, amount=amount
+                )
+                for ingredient, amount in zip(cls.ingredients, amounts)
+                if amount
+            )
+            cls.recipes.append(recipe)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def shopping_list(self):
+        return {
+            ingredient_id: (amount, entries)
+            for ingredient_id, amount, entries
+            in ShopCartIngredient.objects.filter(user=self.user).values_list(
+                'ingredient_id', 'amount', 'entries'
+            )
+        }
+
+    def cart(self, method, recipe):
+        response = getattr(self.client, method)(
+            f'/api/recipes/{recipe.pk}/shopping_cart/'
+        )
+        self.assertIn(response.status_code, (201, 204))
+
+    def test_cart_changes_apply_deltas(self):
+        first, second, third = (
+            ingredient.pk for ingredient in self.ingredients
+        )
+        soup, porridge = self.recipes
+        self.cart('post', soup)
+        self.assertEqual(
+            self.shopping_list(), {first: (100, 1), second: (5, 1)}
+        )
+        self.cart('post', porridge)
+        self.assertEqual(self.shopping_list(), {
+            first: (150, 2), second: (5, 1), third: (7, 1)
+        })
+        self.cart('delete', soup)
+        self.assertEqual(
+            self.shopping_list(), {first: (50, 1), third: (7, 1)}
+        )
+        # Повторное удаление ничего не вычитает.
+        self.cart('delete', soup)
+        self.assertEqual(
+            self.shopping_list(), {first: (50, 1), third: (7, 1)}
+        )
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'txt'}
+        )
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('Ингредиент 0', content)
+        self.assertIn('50', content)
+        self.assertNotIn('Ингредиент 1', content)
+
+    def test_deleted_recipe_leaves_shopping_lists(self):
+        soup, porridge = self.recipes
+        self.cart('post', soup)
+        self.cart('post', porridge)
+        self.client.force_authenticate(self.author)
+        response = self.client.delete(f'/api/recipes/{soup.pk}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.shopping_list(), {
+            self.ingredients[0].pk: (50, 1), self.ingredients[2].pk: (7, 1)
+        })
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, IMAGE_PIPELINE={'ASYNC': False})
+class RecipeUpdateTest(APITransactionTestCase):
+    # Кеши и список покупок обновляются в on_commit.
+    def setUp(self):
+        response_cache.cache.clear()
+        self.author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        self.other = User.objects.create(
+            username='other', email='other@example.com'
+        )
+        self.tag = Tag.objects.create(name='Ужин', color='#000000', slug='d')
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {index}', measurement_unit='г'
+            )
+            for index in range(4)
+        ]
+        self.recipe = Recipe.objects.create(
+            author=self.author,
+            name='Рецепт',
+            image=image_file(),
+            description='Описание',
+            cooking_time=10
+        )
+        self.recipe.tags.set([self.tag])
+        for ingredient, amount in zip(self.ingredients[:3], (1, 2, 3)):
+            RecipeIngredients.objects.create(
+                recipe=self.recipe, ingredient=ingredient, amount=amount
+            )
+        self.other_recipe = Recipe.objects.create(
+            author=self.other,
+            name='Другой рецепт',
+            image=image_file(),
+            description='Описание',
+            cooking_time=10
+        )
+        self.client.force_authenticate(self.other)
+        self.client.post(f'/api/recipes/{self.recipe.pk}/shopping_cart/')
+        self.client.force_authenticate(None)
+
+    def amounts(self, queryset):
+        return dict(queryset.values_list('ingredient_id', 'amount'))
+
+    def patch(self, amounts, **data):
+        self.client.force_authenticate(self.author)
+        response = self.client.patch(f'/api/recipes/{self.recipe.pk}/', {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 10,
+            'tags': [self.tag.pk],
+            'ingredients': [
+                {'id': pk, 'amount': amount}
+                for pk, amount in amounts.items()
+            ],
+            **data
+        }, format='json')
+        self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_sync_touches_only_changed_rows(self):
+        first, second, third, fourth = (
+            ingredient.pk for ingredient in self.ingredients
+        )
+        kept = RecipeIngredients.objects.get(
+            recipe=self.recipe, ingredient_id=first
+        ).pk
+        old_amounts, changed = RecipeIngredients.objects.sync(
+            self.recipe, {first: 1, second: 5, fourth: 4}
+        )
+        self.assertEqual(old_amounts, {first: 1, second: 2, third: 3})
+        self.assertEqual(changed, 3)
+        rows = RecipeIngredients.objects.filter(recipe=self.recipe)
+        self.assertEqual(
+            self.amounts(rows), {first: 1, second: 5, fourth: 4}
+        )
+        self.assertTrue(rows.filter(pk=kept).exists())
+        self.assertEqual(
+            RecipeIngredients.objects.sync(
+                self.recipe, {first: 1, second: 5, fourth: 4}
+            )[1],
+            0
+        )
+
+    def test_update_moves_shopping_list_by_delta(self):
+        first, second, _, fourth = (
+            ingredient.pk for ingredient in self.ingredients
+        )
+        self.patch({first: 1, second: 5, fourth: 4})
+        self.assertEqual(
+            self.amounts(ShopCartIngredient.objects.filter(user=self.other)),
+            {first: 1, second: 5, fourth: 4}
+        )
+
+    def test_update_keeps_unrelated_cached_pages(self):
+        # На первой странице из одного рецепта только более новый чужой.
+        params = {'limit': 1}
+        response = self.client.get('/api/recipes/', params)
+        self.assertEqual(
+            [recipe['id'] for recipe in response.json()['results']],
+            [self.other_recipe.pk]
+        )
+        self.client.get('/api/recipes/')
+        hits = response_cache.stats()['hits']
+        first = self.ingredients[0].pk
+        self.patch({first: 7})
+        self.client.get('/api/recipes/', params)
+        self.assertEqual(response_cache.stats()['hits'], hits + 1)
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response_cache.stats()['hits'], hits + 1)
+        recipe = next(
+            recipe for recipe in response.json()['results']
+            if recipe['id'] == self.recipe.pk
+        )
+        self.assertEqual(
+            [(row['id'], row['amount']) for row in recipe['ingredients']],
+            [(first, 7)]
+        )
+
+    def test_rename_invalidates_search_pages(self):
+        params = {'search': 'пирог'}
+        self.assertEqual(
+            self.client.get('/api/recipes/', params).json()['count'], 0
+        )
+        self.patch({self.ingredients[0].pk: 1}, name='Пирог')
+        self.assertEqual(
+            self.client.get('/api/recipes/', params).json()['count'], 1
+        )
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, IMAGE_PIPELINE={'ASYNC': False})
+class RecipeImportTest(APITransactionTestCase):
+    def setUp(self):
+        self.admin = User.objects.create(
+            username='admin', email='admin@example.com', is_staff=True
+        )
+        self.tag = Tag.objects.create(name='Ужин', color='#000000', slug='d')
+        self.ingredient = Ingredient.objects.create(
+            name='Мука', measurement_unit='г'
+        )
+        self.recipe = Recipe.objects.create(
+            author=self.admin,
+            name='Рецепт',
+            image=image_file(),
+            description='Описание',
+            cooking_time=10
+        )
+        self.recipe.tags.set([self.tag])
+        RecipeIngredients.objects.create(
+            recipe=self.recipe, ingredient=self.ingredient, amount=5
+        )
+
+    def row(self, name, image=None):
+        return json.dumps({
+            'name': name,
+            'text': 'Описание',
+            'cooking_time': 5,
+            'tags': [self.tag.pk],
+            'ingredients': [{'id': self.ingredient.pk, 'amount': 1}],
+            'image': image or self.recipe.image.name,
+        }, ensure_ascii=False) + '\n'
+
+    def test_default_export_imports_back(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/recipes/export/')
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        response = self.client.post(
+            '/api/recipes/import/', content,
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['errors'], [])
+        self.assertEqual(response.data['created'], 1)
+        copy = Recipe.objects.exclude(pk=self.recipe.pk).get()
+        self.assertEqual(copy.image.name, self.recipe.image.name)
+        self.assertEqual(list(copy.tags.all()), [self.tag])
+        self.assertEqual(
+            list(copy.recipeingredients_set.values_list(
+                'ingredient_id', 'amount'
+            )),
+            [(self.ingredient.pk, 5)]
+        )
+
+    def test_missing_image_path_is_rejected(self):
+        importer = RecipeImporter(self.admin)
+        importer.import_rows([self.row('Копия', 'recipe/images/missing.png')])
+        self.assertEqual(importer.stats['created'], 0)
+        self.assertIn('image', importer.errors[0]['errors'])
+
+    def test_errors_report_physical_line_numbers(self):
+        lines = ['\n', self.row('Первый'), '\n', '{oops\n', self.row('')]
+        importer = RecipeImporter(self.admin)
+        importer.import_rows(lines)
+        self.assertEqual(
+            [error['line'] for error in importer.errors], [4, 5]
+        )
+        self.assertEqual(importer.position, 5)
+
+    def test_checkpoint_commits_with_batch(self):
+        lines = ['\n'] + [self.row(f'Рецепт {index}') for index in range(4)]
+        importer = RecipeImporter(self.admin, batch_size=2, checkpoint='f')
+        save = importer.save
+        calls = []
+
+        def crash_on_second_batch(rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError
+            save(rows)
+
+        importer.save = crash_on_second_batch
+        with self.assertRaises(RuntimeError):
+            importer.import_rows(lines)
+        self.assertEqual(ImportCheckpoint.objects.get_position('f'), 3)
+        self.assertEqual(Recipe.objects.count(), 3)
+
+        importer = RecipeImporter(self.admin, batch_size=2, checkpoint='f')
+        importer.import_rows(lines)
+        importer.finish()
+        self.assertEqual(
+            sorted(Recipe.objects.exclude(
+                pk=self.recipe.pk
+            ).values_list('name', flat=True)),
+            [f'Рецепт {index}' for index in range(4)]
+        )
+        self.assertFalse(ImportCheckpoint.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, IMAGE_PIPELINE={'ASYNC': False})
+class RecipeIndexUpdateTest(APITransactionTestCase):
+    # Векторы рецептов пересчитываются в on_commit.
+    def setUp(self):
+        self.author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        self.tags = [
+            Tag.objects.create(
+                name=f'Тег {index}', color=f'#00000{index}', slug=f'tag{index}'
+            )
+            for index in range(3)
+        ]
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {index}', measurement_unit='г'
+            )
+            for index in range(8)
+        ]
+        self.recipes = [
+            self.create_recipe(
+                index, self.ingredients[index % 4:index % 4 + 3 + index % 2]
+            )
+            for index in range(10)
+        ]
+
+    def create_recipe(self, index, ingredients):
+        recipe = Recipe.objects.create(
+            author=self.author,
+            name=f'Рецепт {index}',
+            image=image_file(),
+            description='Описание',
+            cooking_time=10
+        )
+        recipe.tags.set(self.tags[:1 + index % len(self.tags)])
+        for ingredient in ingredients:
+            RecipeIngredients.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=1
+            )
+        return recipe
+
+    def change_recipes(self):
+        first, second = self.recipes[:2]
+        RecipeIngredients.objects.filter(
+            recipe=first, ingredient=self.ingredients[0]
+        ).delete()
+        RecipeIngredients.objects.create(
+            recipe=first, ingredient=self.ingredients[7], amount=1
+        )
+        second.tags.set(self.tags[2:])
+        self.deleted = self.recipes[2].pk
+        self.recipes[2].delete()
+        self.create_recipe(10, self.ingredients[5:8])
+
+    def test_cookable_index_follows_changes(self):
+        index = RecipeIngredientIndex(get_matching_settings())
+        pantry = [ingredient.pk for ingredient in self.ingredients[:5]]
+        index.match(pantry)
+        self.change_recipes()
+        with mock.patch.object(
+            RecipeIngredientIndex, 'build', autospec=True,
+            side_effect=RecipeIngredientIndex.build
+        ) as build:
+            for coverage in (0, 0.5, 1):
+                self.assertEqual(
+                    index.match(pantry, coverage),
+                    RecipeIngredientIndex(get_matching_settings()).match(
+                        pantry, coverage
+                    )
+                )
+        # Полностью строится только свежий индекс, старый обновляется.
+        self.assertEqual(build.call_count, 3)
+        fresh = RecipeIngredientIndex(get_matching_settings())
+        fresh.refresh()
+        self.assertEqual(index.snapshot, fresh.snapshot)
+        self.assertNotIn(self.deleted, index.snapshot.totals)
+
+    def similarity_index(self, **options):
+        return RecipeSimilarityIndex({**get_similar_settings(), **options})
+
+    def test_similar_index_follows_changes(self):
+        # Порог полной сборки поднят, чтобы все правки шли по частям.
+        index = self.similarity_index(REBUILD_RATIO=1)
+        for recipe in self.recipes:
+            index.similar(recipe.pk, 100)
+        self.change_recipes()
+        with mock.patch.object(
+            RecipeSimilarityIndex, 'build', side_effect=AssertionError
+        ):
+            index.refresh()
+        fresh = self.similarity_index()
+        fresh.refresh()
+        self.assertEqual(
+            set(index.snapshot.slots), set(fresh.snapshot.slots)
+        )
+        for pk in fresh.snapshot.slots:
+            with self.subTest(pk=pk):
+                result = index.similar(pk, 100)
+                self.assertEqual(
+                    result, index.neighbours(index.snapshot, pk)
+                )
+                # До полной сборки IDF заморожен: меняются оценки, но не
+                # состав похожих рецептов.
+                self.assertEqual(
+                    {neighbour for neighbour, _ in result},
+                    {neighbour for neighbour, _ in fresh.similar(pk, 100)}
+                )
+
+    def test_similar_cache_is_invalidated_selectively(self):
+        index = self.similarity_index(REBUILD_RATIO=1, MAX_LIMIT=2)
+        for recipe in self.recipes:
+            index.similar(recipe.pk, 2)
+        changed = self.recipes[0]
+        RecipeIngredients.objects.filter(
+            recipe=changed, ingredient=self.ingredients[0]
+        ).delete()
+        index.refresh()
+        self.assertNotIn(changed.pk, index.cache)
+        self.assertTrue(index.cache)
+        for pk, (result, _) in list(index.cache.items()):
+            with self.subTest(pk=pk):
+                self.assertEqual(
+                    result, index.neighbours(index.snapshot, pk)
+                )
+
+
+class RecipesLimitTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(
+            username='viewer', email='viewer@example.com'
+        )
+        cls.author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        for index in range(3):
+            Recipe.objects.create(
+                author=cls.author,
+                name=f'Рецепт {index}',
+                image='recipe/images/test.png',
+                description='Описание',
+                cooking_time=10
+            )
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_negative_limit_is_rejected(self):
+        response = self.client.post(
+            f'/api/users/{self.author.pk}/subscribe/?recipes_limit=-1'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('не может быть отрицательным', str(response.data))
+        self.assertFalse(Subscription.objects.exists())
+        Subscription.objects.create(subscriber=self.user, author=self.author)
+        for limit, message in (
+            ('-1', 'не может быть отрицательным'),
+            ('x', 'должен быть числом'),
+        ):
+            with self.subTest(limit=limit):
+                response = self.client.get(
+                    '/api/users/subscriptions/', {'recipes_limit': limit}
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(message, str(response.data))
+        response = self.client.get(
+            '/api/users/subscriptions/', {'recipes_limit': 2}
+        )
+        self.assertEqual(len(response.data['results'][0]['recipes']), 2)
+
+
+@override_settings(INSTRUMENTATION={'ENABLED': True})
+class InstrumentationTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(
+            username='viewer', email='viewer@example.com'
+        )
+        for index in range(3):
+            ShopCartIngredient.objects.create(
+                user=cls.user,
+                ingredient=Ingredient.objects.create(
+                    name=f'Ингредиент {index}', measurement_unit='г'
+                ),
+                amount=index + 1,
+                entries=1
+            )
+
+    def setUp(self):
+        histograms.clear()
+        self.client.force_authenticate(self.user)
+
+    def test_serialization_time_is_recorded(self):
+        response = self.client.get('/api/users/me/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('serialize;dur=', response['Server-Timing'])
+        stats = histograms.stats()['CustomUserViewSet.me']
+        self.assertGreater(stats['serialize']['max'], 0)
+
+    def test_streaming_queries_are_counted(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'txt'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(
+            'RecipeViewSet.download_shopping_cart', histograms.stats()
+        )
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('Ингредиент 2', content)
+        stats = histograms.stats()['RecipeViewSet.download_shopping_cart']
+        # Версия ингредиентов для ETag и сам список при чтении потока.
+        self.assertEqual(stats['queries']['max'], 2)
+
+
+class InMemoryRecipeSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(
+            username='author', email='author@example.com'
+        )
+        cls.soup, cls.pilaf = (
+            Recipe.objects.create(
+                author=cls.author,
+                name=name,
+                image='recipe/images/test.png',
+                description='Описание',
+                cooking_time=10
+            )
+            for name in ('Борщ', 'Плов')
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.backend = InMemoryRecipeSearch(get_recipe_search_settings())
+
+    def search(self, backend, query):
+        return list(backend.search(Recipe.objects.all(), query))
+
+    def test_index_updates_only_changed_recipes(self):
+        other = InMemoryRecipeSearch(get_recipe_search_settings())
+        self.assertEqual(self.search(self.backend, 'борщ'), [self.soup])
+        self.assertEqual(self.search(other, 'борщ'), [self.soup])
+        Recipe.objects.filter(pk=self.pilaf.pk).update(name='Борщевик')
+        Recipe.objects.filter(pk=self.soup.pk).delete()
+        with mock.patch.object(
+            InMemoryRecipeSearch, 'build', side_effect=AssertionError
+        ), mock.patch.object(
+            InMemoryRecipeSearch, 'documents',
+            autospec=True, side_effect=InMemoryRecipeSearch.documents
+        ) as documents:
+            self.backend.index(Recipe.objects.filter(pk=self.pilaf.pk))
+            self.backend.remove((self.soup.pk,))
+            self.assertEqual(self.search(self.backend, 'борщ'), [self.pilaf])
+            self.assertEqual(self.search(self.backend, 'плов'), [])
+            # Второй процесс догоняет по журналу изменений в кеше.
+            self.assertEqual(self.search(other, 'борщ'), [self.pilaf])
+        self.assertTrue(all(
+            call.args[1] <= {self.soup.pk, self.pilaf.pk}
+            for call in documents.call_args_list
+        ))
+
+    def test_missing_changes_rebuild_index(self):
+        self.search(self.backend, 'борщ')
+        Recipe.objects.filter(pk=self.pilaf.pk).update(name='Борщевик')
+        self.backend.index(Recipe.objects.filter(pk=self.pilaf.pk))
+        cache.clear()
+        other = InMemoryRecipeSearch(get_recipe_search_settings())
+        other.version = self.backend.version - 1
+        with mock.patch.object(
+            InMemoryRecipeSearch, 'build', autospec=True,
+            side_effect=InMemoryRecipeSearch.build
+        ) as build:
+            self.assertEqual(
+                self.search(other, 'борщ'), [self.pilaf, self.soup]
+            )
+        build.assert_called_once()
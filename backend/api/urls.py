@@ -3,6 +3,7 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     CustomUserViewSet,
     IngredientViewSet,
+    InstrumentationView,
     RecipeViewSet,
     TagViewSet,
 )
@@ -14,6 +15,7 @@ router.register('recipes', RecipeViewSet)
 router.register('users', CustomUserViewSet)
 
 urlpatterns = [
+    path('instrumentation/', InstrumentationView.as_view()),
     path('', include(router.urls)),
     path('auth/', include('djoser.urls.authtoken')),
 ]
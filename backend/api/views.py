@@ -1,32 +1,56 @@
+from collections import OrderedDict
+from hashlib import md5
+
 from django.contrib.auth import get_user_model
-from django.db.models import Count, Sum
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.generics import get_object_or_404
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
 
 from recipes.models import (
-    Ingredient, Recipe, Tag, RecipeIngredients
+    DataVersion, Ingredient, Recipe, Tag, ShopCart, ShopCartIngredient
 )
 from users.models import Subscription
-from .filters import CustomIngredientFilter, CustomRecipeFilter
+from .bulk import RecipeExporter, RecipeImporter
+from .cache import (
+    AnonymousListCacheMixin, ReferenceCacheMixin, feed_cache, response_cache
+)
+from .feed import RecipeFeed, decode_cursor, encode_cursor
+from .filters import (
+    RECIPE_ORDERINGS, CustomIngredientFilter, CustomRecipeFilter
+)
+from .instrumentation import SerializationTimingMixin, histograms
+from .matching import get_recipe_index
 from .paginators import CustomPageNumberPagination
 from .permissions import OwnerOrReadOnly
+from .renderers import CSVRenderer, PDFRenderer, TextRenderer
 from .serializers import (
     IngredientSerializer, RecipeSerializer, RecipeShortSerializer,
-    TagSerializer, SubscriptionSerializer,
+    TagSerializer, CookableRecipeSerializer, SimilarRecipeSerializer,
+    SubscriptionSerializer,
     SubscriptionCreateSerializer, FavoriteRecipeSerializer,
     ShopCartSerializer, RecipeCreateSerializer)
+from .signals import invalidate
+from .similar import get_similarity_index
 
 
 User = get_user_model()
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ReferenceCacheMixin, SerializationTimingMixin,
+                        viewsets.ReadOnlyModelViewSet):
+    cache_name = 'ingredients'
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
@@ -34,43 +58,94 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     filterset_class = CustomIngredientFilter
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(ReferenceCacheMixin, SerializationTimingMixin,
+                 viewsets.ReadOnlyModelViewSet):
+    cache_name = 'tags'
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     pagination_class = None
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(AnonymousListCacheMixin, SerializationTimingMixin,
+                    viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     pagination_class = CustomPageNumberPagination
     permission_classes = (OwnerOrReadOnly,)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = CustomRecipeFilter
+    # Параметры RecipeImageField меняют ссылку на изображение в ответе.
+    response_cache_params = ('image_width', 'image_format')
+
+    @property
+    def cursor_ordering(self):
+        if self.action == 'cookable':
+            return None
+        ordering = self.request.query_params.get('ordering', 'newest')
+        return RECIPE_ORDERINGS.get(ordering, RECIPE_ORDERINGS['newest'])
+
+    def get_queryset(self):
+        queryset = Recipe.objects.with_user_flags(self.request.user)
+        if self.action in ('list', 'retrieve', 'feed', 'cookable'):
+            return queryset.with_related(self.request.user)
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ('list', 'feed', 'cookable'):
+            context['image_width'] = 640
+        return context
 
     def get_serializer_class(self):
-        if self.action in ('list', 'retrieve'):
+        if self.action in ('list', 'retrieve', 'feed', 'cookable'):
             return RecipeSerializer
         return RecipeCreateSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
+        User.objects.adjust_counters(self.request.user.pk, recipes_count=1)
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        ShopCartIngredient.objects.remove_recipe(
+            list(instance.in_shopping_cart.values_list('user_id', flat=True)),
+            instance
+        )
+        instance.delete()
+        User.objects.adjust_counters(instance.author_id, recipes_count=-1)
 
     def add_or_delete(self, serializer_cls, pk):
+        model = serializer_cls.Meta.model
         if self.request.method == 'POST':
             serializer_obj = serializer_cls(
                 data={'recipe': pk},
                 context={'request': self.request}
             )
             serializer_obj.is_valid(raise_exception=True)
-            cart = serializer_obj.save()
+            with transaction.atomic():
+                cart = serializer_obj.save()
+                Recipe.objects.adjust_counters(
+                    cart.recipe_id, **{model.counter_field: 1}
+                )
+                invalidate((f'recipe:{cart.recipe_id}',))
 
             serializer = RecipeShortSerializer(cart.recipe)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         if self.request.method == 'DELETE':
-            serializer_cls.Meta.model.objects.filter(
-                recipe=pk, user=self.request.user
-            ).delete()
+            with transaction.atomic():
+                deleted, _ = model.objects.filter(
+                    recipe=pk, user=self.request.user
+                ).delete()
+                if deleted:
+                    Recipe.objects.adjust_counters(
+                        pk, **{model.counter_field: -1}
+                    )
+                    invalidate((f'recipe:{pk}',))
+                if deleted and model is ShopCart:
+                    ShopCartIngredient.objects.remove_recipe(
+                        [self.request.user.id], pk
+                    )
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({
             'errors': 'Некорректный запрос'
@@ -87,42 +162,195 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return self.add_or_delete(ShopCartSerializer, pk)
 
     @action(detail=False, methods=('get',),
-            permission_classes=(IsAuthenticated,))
+            permission_classes=(IsAuthenticated,),
+            renderer_classes=(TextRenderer, CSVRenderer, PDFRenderer))
     def download_shopping_cart(self, request):
-        full_shopping_cart = RecipeIngredients.objects.filter(
-            recipe__in_shopping_cart__user=request.user
-        ).values(
-            'ingredient__name', 'ingredient__measurement_unit'
-        ).annotate(
-            count=Count('ingredient__name')
+        shopping_list = ShopCartIngredient.objects.filter(user=request.user)
+        etag, last_modified = self.get_shopping_cart_validators(
+            request.user
+        )
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is not None:
+            return response
+
+        full_shopping_cart = shopping_list.values_list(
+            'ingredient__name', 'ingredient__measurement_unit', 'amount'
         ).order_by(
-            'ingredient'
-        ).annotate(
-            amount=Sum('amount')
+            'ingredient__name', 'ingredient__measurement_unit'
+        ).iterator()
+
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.stream(full_shopping_cart),
+            content_type=renderer.media_type
+        )
+        response['Content-Disposition'] = (
+            'attachment; '
+            f'filename="ingredients_to_buy.{renderer.format}"'
         )
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
 
-        result = 'Список покупок: \n' + '\n'.join([
-            (f'{i["ingredient__name"]} '
-             f'({i["ingredient__measurement_unit"]}) - '
-             f'{i["amount"]}')
-            for i in full_shopping_cart
-        ])
+    @action(detail=False, methods=('get',),
+            permission_classes=(IsAuthenticated,))
+    def feed(self, request):
+        feed = RecipeFeed(request.user)
+        recipes, next_position = feed.page(
+            self.get_queryset(),
+            decode_cursor(request.query_params.get('cursor')),
+            self.paginator.get_page_size(request)
+        )
+        next_url = None
+        if next_position is not None:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor',
+                encode_cursor(next_position)
+            )
+        serializer = self.get_serializer(recipes, many=True)
+        return Response(OrderedDict([
+            ('next', next_url),
+            ('results', serializer.data)
+        ]))
 
-        response = HttpResponse(result, content_type='text/plain')
+    @action(detail=False, methods=('get',))
+    def cookable(self, request):
+        ingredients = self.get_ingredient_ids()
+        min_coverage = self.get_min_coverage()
+        page = self.paginate_queryset(
+            get_recipe_index().match(ingredients, min_coverage)
+        )
+        recipes = self.get_queryset().in_bulk([pk for pk, _, _ in page])
+        context = self.get_serializer_context()
+        context['matches'] = {
+            pk: (matched, total) for pk, matched, total in page
+        }
+        serializer = CookableRecipeSerializer(
+            [recipes[pk] for pk, _, _ in page if pk in recipes],
+            many=True, context=context
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=('get',))
+    def similar(self, request, pk=None):
+        if not str(pk).isdigit():
+            raise NotFound()
+        neighbours = get_similarity_index().similar(
+            int(pk), self.paginator.get_page_size(request)
+        )
+        if not neighbours and not Recipe.objects.filter(pk=pk).exists():
+            raise NotFound()
+        recipes = Recipe.objects.prefetch_related('renditions').in_bulk(
+            [recipe_id for recipe_id, _ in neighbours]
+        )
+        serializer = SimilarRecipeSerializer(
+            [
+                recipes[recipe_id] for recipe_id, _ in neighbours
+                if recipe_id in recipes
+            ],
+            many=True,
+            context={
+                **self.get_serializer_context(),
+                'similarity': dict(neighbours)
+            }
+        )
+        return Response(serializer.data)
+
+    def get_ingredient_ids(self):
+        values = ','.join(self.request.query_params.getlist('ingredients'))
+        try:
+            ids = {int(value) for value in values.split(',') if value}
+        except ValueError:
+            raise ValidationError('ingredients должен быть списком чисел')
+        if not ids:
+            raise ValidationError('Укажите хотя бы один ингредиент')
+        return ids
+
+    def get_min_coverage(self):
+        value = self.request.query_params.get('min_coverage', '0')
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValidationError('min_coverage должен быть числом')
+        if not 0 <= value <= 1:
+            raise ValidationError('min_coverage должен быть от 0 до 1')
+        return value
+
+    @action(detail=False, methods=('get',),
+            permission_classes=(IsAdminUser,))
+    def cache_stats(self, request):
+        return Response({
+            cache.name: cache.stats() for cache in (response_cache, feed_cache)
+        })
+
+    @action(detail=False, methods=('post',), url_path='import',
+            permission_classes=(IsAdminUser,))
+    def bulk_import(self, request):
+        start = request.query_params.get('start', '0')
+        if not start.isdigit():
+            raise ValidationError('start должен быть числом')
+        importer = RecipeImporter(request.user, start=int(start))
+        stats = importer.import_rows(request.stream or ())
+        return Response({
+            **stats,
+            'position': importer.position,
+            'errors': importer.errors
+        })
+
+    @action(detail=False, methods=('get',), url_path='export',
+            permission_classes=(IsAdminUser,))
+    def bulk_export(self, request):
+        exporter = RecipeExporter(
+            inline_images=request.query_params.get('images') == 'inline',
+            build_url=request.build_absolute_uri
+        )
+        response = StreamingHttpResponse(
+            exporter.stream(), content_type='application/x-ndjson'
+        )
         response['Content-Disposition'] = (
-            'attachment; filename="ingredients_to_buy.txt"'
+            'attachment; filename="recipes.ndjson"'
         )
         return response
 
+    def get_shopping_cart_validators(self, user):
+        # Версия списка растёт при каждой записи в него, а версия
+        # ингредиентов - при смене их названий и единиц измерения.
+        signature = ':'.join((
+            self.request.accepted_renderer.format,
+            str(user.cart_version),
+            str(DataVersion.objects.get_version('ingredients'))
+        ))
+        etag = quote_etag(md5(signature.encode()).hexdigest())
+        last_modified = user.cart_updated
+        if last_modified is not None:
+            last_modified = int(last_modified.timestamp())
+        return etag, last_modified
+
 
-class CustomUserViewSet(UserViewSet):
+class CustomUserViewSet(SerializationTimingMixin, UserViewSet):
     pagination_class = CustomPageNumberPagination
+    cursor_ordering = ('username', 'id')
 
     @action(detail=False, methods=('get',),
             permission_classes=(IsAuthenticated,))
     def subscriptions(self, request):
+        recipes_limit = self.get_recipes_limit()
         paginated_queryset = self.paginate_queryset(
-            User.objects.filter(subscribers__subscriber=request.user)
+            User.objects.filter(
+                subscribers__subscriber=request.user
+            ).with_subscription_flag(request.user)
+        )
+        recipes = Recipe.objects.prefetch_related('renditions')
+        if paginated_queryset and recipes_limit is not None:
+            recipes = recipes.first_per_author(
+                paginated_queryset, recipes_limit
+            )
+        prefetch_related_objects(
+            paginated_queryset,
+            Prefetch('recipes', queryset=recipes, to_attr='recipes_preview')
         )
         serializer = SubscriptionSerializer(
             paginated_queryset,
@@ -130,18 +358,38 @@ class CustomUserViewSet(UserViewSet):
         )
         return self.get_paginated_response(serializer.data)
 
+    def get_recipes_limit(self):
+        limit = self.request.query_params.get('recipes_limit')
+        if not limit:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValidationError('recipes_limit должен быть числом')
+        if limit < 0:
+            raise ValidationError(
+                'recipes_limit не может быть отрицательным'
+            )
+        return limit
+
     @action(detail=True, methods=('post', 'delete'),
             permission_classes=(IsAuthenticated,))
     def subscribe(self, request, id=None):
         author = get_object_or_404(User, pk=id)
 
         if self.request.method == 'POST':
+            # Параметр проверяется до записи подписки.
+            self.get_recipes_limit()
             sub_serializer = SubscriptionCreateSerializer(
                 data={'author': id},
                 context={'request': request}
             )
             sub_serializer.is_valid(raise_exception=True)
-            sub_serializer.save()
+            with transaction.atomic():
+                sub_serializer.save()
+                User.objects.adjust_counters(author.pk, subscribers_count=1)
+                invalidate((f'user:{author.pk}', f'feed:{request.user.pk}'))
+                author.subscribers_count += 1
 
             serializer = SubscriptionSerializer(
                 author,
@@ -155,8 +403,22 @@ class CustomUserViewSet(UserViewSet):
                 author=author,
                 subscriber=request.user
             )
-            subscription.delete()
+            with transaction.atomic():
+                subscription.delete()
+                User.objects.adjust_counters(author.pk, subscribers_count=-1)
+                invalidate((f'user:{author.pk}', f'feed:{request.user.pk}'))
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response({
             'errors': 'Некорректный запрос'
         }, status=status.HTTP_400_BAD_REQUEST)
+
+
+class InstrumentationView(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(histograms.stats())
+
+    def delete(self, request):
+        histograms.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -26,7 +26,13 @@ INSTALLED_APPS = [
     "colorfield",
 ]
 
+if 'postgresql' in (os.environ.get('DB_ENGINE') or ''):
+    # Lookup trigram_similar для INGREDIENT_SEARCH['TRIGRAM']; расширение
+    # pg_trgm создаёт миграция recipes.0013_ingredient_trigram_index.
+    INSTALLED_APPS.append('django.contrib.postgres')
+
 MIDDLEWARE = [
+    'api.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -113,6 +119,72 @@ REST_FRAMEWORK = {
     ],
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    },
+    'responses': {
+        'BACKEND': os.environ.get(
+            'RESPONSE_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.environ.get('RESPONSE_CACHE_LOCATION', 'responses'),
+        'TIMEOUT': 60 * 10,
+        # MAX_ENTRIES понимает только LocMemCache, у внешних кешей свой
+        # лимит памяти.
+        'OPTIONS': {} if os.environ.get('RESPONSE_CACHE_BACKEND') else {
+            'MAX_ENTRIES': int(os.environ.get('RESPONSE_CACHE_ENTRIES', 10000)),
+        },
+    },
+}
+
+RESPONSE_CACHE = {
+    'CACHE': 'responses',
+    'TIMEOUT': 60 * 10,
+}
+
+INGREDIENT_SEARCH = {
+    'BACKEND': os.environ.get(
+        'INGREDIENT_SEARCH_BACKEND', 'api.search.DatabaseIngredientSearch'
+    ),
+    'LIMIT': 50,
+    'TRIGRAM': os.environ.get('INGREDIENT_SEARCH_TRIGRAM') == 'true',
+}
+
+RECIPE_SEARCH = {
+    'BACKEND': os.environ.get(
+        'RECIPE_SEARCH_BACKEND',
+        'api.search.PostgresRecipeSearch'
+        if 'postgresql' in (os.environ.get('DB_ENGINE') or '')
+        else 'api.search.InMemoryRecipeSearch'
+    ),
+    'CONFIG': 'russian',
+}
+
+# Маски тегов у существующих рецептов заполняет миграция
+# recipes.0009_fill_tags_mask, дальше их поддерживают сигналы m2m_changed.
+# Побитовое И не использует индекс: фильтр проверяет каждую строку
+# рецептов и выигрывает только за счёт отсутствия подзапроса.
+RECIPE_FILTERS = {
+    'TAG_BITMASK': False,
+}
+
+INSTRUMENTATION = {
+    'ENABLED': os.environ.get('INSTRUMENTATION_ENABLED') == 'true',
+    'SLOW_REQUEST_MS': int(os.environ.get('SLOW_REQUEST_MS', 500)),
+}
+
+IMAGE_PIPELINE = {
+    'MAX_SIZE': 10 * 1024 * 1024,
+    'MAX_WIDTH': 8000,
+    'MAX_HEIGHT': 8000,
+    'WORKERS': 2,
+}
+
 DJOSER = {
     'LOGIN_FIELD': 'email',
     'HIDE_USERS': False,
@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 from .models import (
-    Ingredient, FavoriteRecipes, Recipe, RecipeIngredients, ShopCart, Tag
+    Ingredient, FavoriteRecipes, Recipe, RecipeIngredients, ShopCart,
+    ShopCartIngredient, Tag
 )
 
 
@@ -25,14 +26,14 @@ class RecipeAdmin(admin.ModelAdmin):
     )
     readonly_fields = ('pub_date', 'get_in_favorites')
     inlines = [RecipeIngredientsInline]
-    list_display = ('pk', 'name', 'author')
+    list_display = ('pk', 'name', 'author', 'favorites_count', 'cart_count')
     search_fields = ('author', 'name', 'tags')
     empty_value_display = '-пусто-'
     date_hierarchy = 'pub_date'
     ordering = ('-pub_date', )
 
     def get_in_favorites(self, obj):
-        return obj.in_favorite.count()
+        return obj.favorites_count
 
     get_in_favorites.short_description = 'Добавлен в избранное'
 
@@ -63,3 +64,11 @@ class ShopCartAdmin(admin.ModelAdmin):
     list_display = ('pk', 'recipe', 'user')
     search_fields = ('recipe', 'user')
     empty_value_display = '-пусто-'
+
+
+@admin.register(ShopCartIngredient)
+class ShopCartIngredientAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'user', 'ingredient', 'amount', 'entries')
+    search_fields = ('user__username', 'ingredient__name')
+    readonly_fields = ('user', 'ingredient', 'amount', 'entries', 'updated')
+    empty_value_display = '-пусто-'
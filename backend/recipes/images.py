@@ -0,0 +1,118 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .models import MediaFile, Recipe, RecipeImageRendition
+
+DEFAULTS = {
+    'MAX_SIZE': 10 * 1024 * 1024,
+    'MAX_WIDTH': 8000,
+    'MAX_HEIGHT': 8000,
+    'RENDITIONS': (
+        ('thumbnail', 160),
+        ('medium', 640),
+    ),
+    'FORMATS': ('jpeg', 'webp'),
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'ASYNC': True,
+}
+
+_executor = None
+logger = logging.getLogger(__name__)
+
+
+def get_image_settings():
+    return {**DEFAULTS, **getattr(settings, 'IMAGE_PIPELINE', {})}
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=get_image_settings()['WORKERS'],
+            thread_name_prefix='renditions'
+        )
+    return _executor
+
+
+def schedule_renditions(recipe_id):
+    if get_image_settings()['ASYNC']:
+        transaction.on_commit(
+            lambda: get_executor().submit(run_in_worker, recipe_id)
+        )
+    else:
+        transaction.on_commit(lambda: generate_renditions(recipe_id))
+
+
+def run_in_worker(recipe_id):
+    close_old_connections()
+    try:
+        generate_renditions(recipe_id)
+    except Exception:
+        logger.exception('Не удалось обработать изображение рецепта %s',
+                         recipe_id)
+    finally:
+        close_old_connections()
+
+
+def render(image, width, image_format, quality):
+    copy = image.copy()
+    copy.thumbnail((width, width), Image.LANCZOS)
+    if image_format == 'jpeg' and copy.mode not in ('RGB', 'L'):
+        copy = copy.convert('RGB')
+    buffer = BytesIO()
+    copy.save(buffer, image_format.upper(), quality=quality)
+    return copy.size, buffer.getvalue()
+
+
+def generate_renditions(recipe_id):
+    recipe = Recipe.objects.filter(pk=recipe_id).first()
+    if recipe is None or not recipe.image:
+        return
+    options = get_image_settings()
+    source = recipe.image.name
+    renditions = []
+    with recipe.image.open('rb') as file, Image.open(file) as image:
+        image = ImageOps.exif_transpose(image)
+        for name, width in options['RENDITIONS']:
+            for image_format in options['FORMATS']:
+                (width, height), content = render(
+                    image, width, image_format, options['QUALITY']
+                )
+                rendition = RecipeImageRendition(
+                    recipe=recipe,
+                    source=source,
+                    name=name,
+                    image_format=image_format,
+                    width=width,
+                    height=height
+                )
+                rendition.image.save(
+                    f'{name}.{image_format}',
+                    ContentFile(content),
+                    save=False
+                )
+                renditions.append(rendition)
+    with transaction.atomic():
+        recipe.renditions.all().delete()
+        if Recipe.objects.filter(pk=recipe_id, image=source).exists():
+            RecipeImageRendition.objects.bulk_create(renditions)
+            MediaFile.objects.acquire(
+                rendition.image.name for rendition in renditions
+            )
+
+
+def select_rendition(recipe, width, image_format):
+    fitting = [
+        rendition for rendition in recipe.renditions.all()
+        if rendition.source == recipe.image.name
+        and rendition.image_format == image_format
+        and rendition.width >= width
+    ]
+    return min(fitting, key=lambda rendition: rendition.width, default=None)
@@ -0,0 +1,117 @@
+import csv
+import json
+import os
+from itertools import islice
+from time import monotonic
+
+from .models import DataVersion, Ingredient
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if len(row) >= 2:
+            yield {'name': row[0], 'measurement_unit': row[1]}
+
+
+def read_json(file, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    while True:
+        chunk = file.read(chunk_size)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if not chunk:
+                    raise
+                break
+            yield item
+        if not chunk:
+            return
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
+    '.ndjson': read_json,
+}
+
+
+class IngredientImporter:
+    def __init__(self, batch_size=1000, dry_run=False, report=None):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.report = report or (lambda stats: None)
+        self.planned = set()
+        self.stats = {
+            'rows': 0, 'created': 0, 'existing': 0,
+            'duplicates': 0, 'invalid': 0
+        }
+        self.created_sample = []
+
+    def import_file(self, path):
+        reader = READERS.get(os.path.splitext(path)[1].lower())
+        if reader is None:
+            raise ValueError(f'Неподдерживаемый формат файла: {path}')
+        with open(path, encoding='utf-8') as file:
+            return self.import_rows(reader(file))
+
+    def import_rows(self, rows):
+        started = monotonic()
+        rows = iter(rows)
+        batch = list(islice(rows, self.batch_size))
+        while batch:
+            self.import_batch(batch)
+            self.stats['elapsed'] = monotonic() - started
+            self.report(self.stats)
+            batch = list(islice(rows, self.batch_size))
+        if self.stats['created'] and not self.dry_run:
+            DataVersion.objects.bump('ingredients')
+        return self.stats
+
+    def clean(self, batch):
+        keys = {}
+        for item in batch:
+            self.stats['rows'] += 1
+            name = str(item.get('name') or '').strip()
+            unit = str(item.get('measurement_unit') or '').strip()
+            if not name or not unit:
+                self.stats['invalid'] += 1
+            elif (name, unit) in keys:
+                self.stats['duplicates'] += 1
+            else:
+                keys[(name, unit)] = None
+        return list(keys)
+
+    def import_batch(self, batch):
+        keys = self.clean(batch)
+        existing = set(Ingredient.objects.filter(
+            name__in={name for name, _ in keys}
+        ).values_list('name', 'measurement_unit'))
+        if self.dry_run:
+            existing |= self.planned & set(keys)
+        new = [key for key in keys if key not in existing]
+        self.stats['existing'] += len(keys) - len(new)
+        self.stats['created'] += len(new)
+        if self.dry_run:
+            self.planned.update(new)
+            self.created_sample.extend(new[:20 - len(self.created_sample)])
+            return
+        Ingredient.objects.bulk_create(
+            [
+                Ingredient(
+                    name=name,
+                    measurement_unit=unit,
+                    search_name=name.casefold()
+                )
+                for name, unit in new
+            ],
+            ignore_conflicts=True
+        )
@@ -0,0 +1,175 @@
+import json
+import random
+from collections import Counter
+from statistics import mean
+from time import perf_counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from api.instrumentation import percentile
+from recipes.models import Ingredient, Recipe, Tag
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Benchmarking the main API endpoints in-process."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests', type=int, default=50,
+            help='Количество замеров для каждого сценария'
+        )
+        parser.add_argument(
+            '--warmup', type=int, default=3,
+            help='Количество запросов для прогрева перед замером'
+        )
+        parser.add_argument(
+            '--user',
+            help='Имя пользователя, от которого выполняются запросы'
+        )
+        parser.add_argument(
+            '--scenario', action='append',
+            help='Запустить только указанные сценарии'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=42,
+            help='Зерно генератора для повторяемых запросов'
+        )
+        parser.add_argument(
+            '--output',
+            help='Файл, в который записываются результаты'
+        )
+        parser.add_argument(
+            '--baseline',
+            help='Файл с результатами прошлого запуска для сравнения'
+        )
+
+    def get_user(self, username):
+        if username:
+            user = User.objects.filter(username=username).first()
+        else:
+            user = User.objects.annotate(
+                carts=Count('shopping_list')
+            ).order_by('-carts', 'pk').first()
+        if user is None:
+            raise CommandError('Нет пользователя для замера')
+        return user
+
+    def scenarios(self, user):
+        tags = list(Tag.objects.order_by('pk').values_list('slug', flat=True))
+        names = list(Ingredient.objects.order_by('pk').values_list(
+            'name', flat=True
+        ))
+        names = self.random.sample(names, min(100, len(names)))
+        author = Recipe.objects.order_by('pk').values_list(
+            'author', flat=True
+        ).first()
+        choice = self.random.choice
+        return {
+            'recipes': lambda: '/api/recipes/',
+            'recipes_page': lambda: (
+                f'/api/recipes/?page={self.random.randint(1, 20)}'
+            ),
+            'recipes_tags': lambda: '/api/recipes/?' + '&'.join(
+                f'tags={slug}' for slug in self.random.sample(
+                    tags, min(2, len(tags))
+                )
+            ),
+            'recipes_author': lambda: f'/api/recipes/?author={author}',
+            'recipes_favorited': lambda: '/api/recipes/?is_favorited=1',
+            'recipes_in_cart': lambda: '/api/recipes/?is_in_shopping_cart=1',
+            'recipes_popular': lambda: '/api/recipes/?ordering=popular',
+            'subscriptions': lambda: (
+                '/api/users/subscriptions/?recipes_limit=3'
+            ),
+            'shopping_cart': lambda: '/api/recipes/download_shopping_cart/',
+            'ingredient_search': lambda: (
+                f'/api/ingredients/?name={choice(names)[:3]}'
+                if names else '/api/ingredients/'
+            ),
+        }
+
+    def measure(self, client, url):
+        with CaptureQueriesContext(connection) as queries:
+            started = perf_counter()
+            response = client.get(url)
+            if response.streaming:
+                size = sum(len(chunk) for chunk in response.streaming_content)
+            else:
+                size = len(response.content)
+            duration = (perf_counter() - started) * 1000
+        return response.status_code, duration, len(queries), size
+
+    def run(self, client, make_url, count, warmup):
+        for _ in range(warmup):
+            self.measure(client, make_url())
+        samples = [self.measure(client, make_url()) for _ in range(count)]
+        durations = sorted(sample[1] for sample in samples)
+        queries = sorted(sample[2] for sample in samples)
+        return {
+            'requests': count,
+            'statuses': dict(Counter(sample[0] for sample in samples)),
+            'latency_ms': {
+                'p50': percentile(durations, 0.5),
+                'p95': percentile(durations, 0.95),
+                'p99': percentile(durations, 0.99),
+                'mean': round(mean(durations), 2),
+                'max': round(durations[-1], 2),
+            },
+            'queries': {
+                'p50': percentile(queries, 0.5),
+                'max': queries[-1],
+            },
+            'bytes': round(mean(sample[3] for sample in samples)),
+        }
+
+    def compare(self, results, baseline):
+        for name, result in results.items():
+            previous = baseline.get(name)
+            if previous is None:
+                continue
+            latency = result['latency_ms']['p95']
+            before = previous['latency_ms']['p95']
+            change = (latency - before) / before * 100 if before else 0
+            queries = result['queries']['max'] - previous['queries']['max']
+            self.stdout.write(
+                f'{name}: p95 {before} -> {latency} мс ({change:+.0f}%), '
+                f'запросов к БД {queries:+d}'
+            )
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('Нужен хотя бы один замер')
+        self.random = random.Random(options['seed'])
+        user = self.get_user(options['user'])
+        client = APIClient()
+        client.force_authenticate(user)
+        scenarios = self.scenarios(user)
+        selected = options['scenario'] or list(scenarios)
+        unknown = set(selected) - set(scenarios)
+        if unknown:
+            raise CommandError(
+                f'Неизвестные сценарии: {", ".join(sorted(unknown))}'
+            )
+        results = {
+            name: self.run(
+                client, scenarios[name],
+                options['requests'], options['warmup']
+            )
+            for name in selected
+        }
+        report = json.dumps(results, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(report)
+        else:
+            self.stdout.write(report)
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                self.compare(results, json.load(file))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe, RecipeVector
+
+
+class Command(BaseCommand):
+    help = "Building ingredient and tag vectors for similar recipes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько рецептов обрабатывать за раз'
+        )
+
+    def handle(self, *args, **options):
+        ids = list(Recipe.objects.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        for start in range(0, len(ids), batch_size):
+            RecipeVector.objects.rebuild(ids[start:start + batch_size])
+            self.stdout.write(
+                f'Обработано рецептов: {min(start + batch_size, len(ids))}'
+            )
+        self.stdout.write(self.style.SUCCESS('Векторы рецептов обновлены'))
@@ -0,0 +1,95 @@
+import os
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from recipes.models import (
+    MediaFile, Recipe, RecipeImageRendition, media_storage
+)
+
+
+class Command(BaseCommand):
+    help = "Removing recipe images that are no longer referenced."
+    directories = ('recipe/images', 'recipe/renditions')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать файлы, которые будут удалены'
+        )
+        parser.add_argument(
+            '--grace-hours',
+            type=int,
+            default=24,
+            help='Не удалять файлы, изменённые позже указанного срока'
+        )
+        parser.add_argument(
+            '--recount',
+            action='store_true',
+            help='Пересчитать ссылки по рецептам и файлам в хранилище'
+        )
+
+    def walk(self, directory):
+        if not media_storage.exists(directory):
+            return
+        directories, files = media_storage.listdir(directory)
+        for name in files:
+            yield os.path.join(directory, name)
+        for name in directories:
+            yield from self.walk(os.path.join(directory, name))
+
+    @transaction.atomic
+    def recount(self):
+        references = Counter(
+            Recipe.objects.exclude(image='').values_list('image', flat=True)
+        )
+        references.update(
+            RecipeImageRendition.objects.values_list('image', flat=True)
+        )
+        names = set(references)
+        for directory in self.directories:
+            names.update(self.walk(directory))
+        stored = dict(MediaFile.objects.values_list('name', 'references'))
+        changed = 0
+        for name in names:
+            if name not in stored:
+                MediaFile.objects.create(
+                    name=name, references=references[name]
+                )
+                changed += 1
+            elif stored[name] != references[name]:
+                MediaFile.objects.filter(name=name).update(
+                    references=references[name]
+                )
+                changed += 1
+        return changed
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            changed = self.recount()
+            self.stdout.write(f'Исправлено счётчиков: {changed}')
+        deadline = timezone.now() - timedelta(hours=options['grace_hours'])
+        orphans = MediaFile.objects.filter(
+            references__lte=0, updated__lt=deadline
+        )
+        removed = 0
+        for media_file in orphans.iterator():
+            if options['dry_run']:
+                self.stdout.write(media_file.name)
+                removed += 1
+                continue
+            with transaction.atomic():
+                deleted, _ = MediaFile.objects.filter(
+                    pk=media_file.pk, references__lte=0,
+                    updated__lt=deadline
+                ).delete()
+                if deleted:
+                    media_storage.delete(media_file.name)
+                    removed += deleted
+        self.stdout.write(self.style.SUCCESS(
+            f'Неиспользуемых файлов: {removed}'
+        ))
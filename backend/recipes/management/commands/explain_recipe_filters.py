@@ -0,0 +1,255 @@
+import json
+import random
+from datetime import timedelta
+from itertools import combinations
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import DateTimeField, DurationField, ExpressionWrapper, F
+from django.db.models.functions import Now
+from django.test import RequestFactory
+
+from api.filters import CustomRecipeFilter
+from api.paginator import explain_plan
+from recipes.models import FavoriteRecipes, Recipe, RecipeScore, ShopCart, Tag
+
+User = get_user_model()
+FILTERS = ('tags', 'author', 'is_favorited', 'is_in_shopping_cart')
+ORDERINGS = ('newest', 'popular')
+PREFIX = 'explain_bench'
+
+
+class Command(BaseCommand):
+    help = "Recording EXPLAIN plans for every recipe filter combination."
+    batch_size = 10000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--recipes',
+            type=int,
+            default=0,
+            help='Сколько тестовых рецептов создать перед замером'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=42,
+            help='Зерно генератора для повторяемых наборов данных'
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Не удалять созданные для замера данные'
+        )
+        parser.add_argument(
+            '--cleanup',
+            action='store_true',
+            help='Только удалить данные, оставшиеся от прошлых замеров'
+        )
+        parser.add_argument(
+            '--output',
+            help='Файл, в который записываются планы запросов'
+        )
+        parser.add_argument(
+            '--baseline',
+            help='Файл с планами для поиска регрессий индексов'
+        )
+        parser.add_argument(
+            '--analyze',
+            action='store_true',
+            help='Выполнять запросы (EXPLAIN ANALYZE)'
+        )
+
+    def seed(self, count):
+        if User.objects.filter(username__startswith=f'{PREFIX}_').exists():
+            raise CommandError(
+                'Остались данные прошлого замера, удалите их через --cleanup'
+            )
+        User.objects.bulk_create([
+            User(
+                username=f'{PREFIX}_{index}',
+                email=f'{PREFIX}_{index}@example.com',
+                password='!'
+            )
+            for index in range(max(count // 20, 10))
+        ])
+        users = list(User.objects.filter(
+            username__startswith=f'{PREFIX}_'
+        ).order_by('pk').values_list('pk', flat=True))
+        tags = list(Tag.objects.values_list('pk', flat=True))
+        first = None
+        for start in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - start)
+            Recipe.objects.bulk_create(
+                Recipe(
+                    author_id=self.random.choice(users),
+                    name=f'{PREFIX} {start + index}',
+                    image='recipe/images/bench.png',
+                    description=PREFIX,
+                    cooking_time=self.random.randint(1, 120)
+                )
+                for index in range(size)
+            )
+            if first is None:
+                first = Recipe.objects.filter(
+                    description=PREFIX
+                ).order_by('pk').values_list('pk', flat=True).first()
+            self.stdout.write(f'Создано рецептов: {start + size}')
+        recipes = Recipe.objects.filter(description=PREFIX)
+        self.seed_relations(recipes, users, tags)
+        self.seed_scores(recipes)
+        if connection.vendor == 'postgresql':
+            recipes.update(pub_date=ExpressionWrapper(
+                Now() - ExpressionWrapper(
+                    (F('id') - first) * timedelta(minutes=1),
+                    output_field=DurationField()
+                ),
+                output_field=DateTimeField()
+            ))
+
+    def seed_relations(self, recipes, users, tags):
+        ids = list(recipes.order_by('pk').values_list('pk', flat=True))
+        RecipeTags = Recipe.tags.through
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start + self.batch_size]
+            if tags:
+                RecipeTags.objects.bulk_create(
+                    (
+                        RecipeTags(recipe_id=pk, tag_id=tag)
+                        for pk in batch
+                        for tag in self.random.sample(
+                            tags, min(2, len(tags))
+                        )
+                    ),
+                    ignore_conflicts=True
+                )
+            for model, share in ((FavoriteRecipes, 1), (ShopCart, 2)):
+                model.objects.bulk_create(
+                    (
+                        model(
+                            recipe_id=pk, user_id=self.random.choice(users)
+                        )
+                        for pk in batch[::share]
+                    ),
+                    ignore_conflicts=True
+                )
+
+    def seed_scores(self, recipes):
+        # Сортировка popular соединяется с рейтингами, без них созданные
+        # рецепты в план не попадут.
+        ids = list(recipes.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(ids), self.batch_size):
+            RecipeScore.objects.bulk_create(
+                (
+                    RecipeScore(
+                        recipe_id=pk,
+                        popular=self.random.random(),
+                        trending=self.random.random()
+                    )
+                    for pk in ids[start:start + self.batch_size]
+                ),
+                ignore_conflicts=True
+            )
+
+    def cleanup(self):
+        users = User.objects.filter(username__startswith=f'{PREFIX}_')
+        deleted, _ = Recipe.objects.filter(author__in=users).delete()
+        users.delete()
+        self.stdout.write(f'Удалено объектов прошлых замеров: {deleted}')
+
+    def sample_params(self):
+        user = User.objects.filter(pk=FavoriteRecipes.objects.values_list(
+            'user_id', flat=True
+        ).first()).first() or User.objects.first()
+        if user is None:
+            raise CommandError('Нет пользователей для замера')
+        recipe = Recipe.objects.first()
+        tag = Tag.objects.first()
+        return user, {
+            'tags': [tag.slug] if tag else [],
+            'author': recipe.author_id if recipe else user.pk,
+            'is_favorited': 1,
+            'is_in_shopping_cart': 1,
+        }
+
+    def queries(self):
+        user, values = self.sample_params()
+        request = RequestFactory().get('/api/recipes/')
+        request.user = user
+        for ordering in ORDERINGS:
+            for size in range(len(FILTERS) + 1):
+                for names in combinations(FILTERS, size):
+                    data = {name: values[name] for name in names}
+                    data['ordering'] = ordering
+                    name = '+'.join((*names, ordering))
+                    filterset = CustomRecipeFilter(
+                        data,
+                        queryset=Recipe.objects.with_user_flags(user),
+                        request=request
+                    )
+                    if not filterset.is_valid():
+                        raise CommandError(
+                            f'{name}: фильтры не применились: '
+                            f'{filterset.errors.as_text()}'
+                        )
+                    yield name, filterset.qs[:6]
+
+    def explain(self, queryset, analyze):
+        options = {'analyze': True} if analyze else {}
+        if connection.vendor != 'postgresql':
+            return {'plan': queryset.explain(**options), 'scans': []}
+        plan = explain_plan(queryset, analyze)
+        return {
+            'plan': plan,
+            'cost': plan['Plan']['Total Cost'],
+            'scans': sorted(self.scans(plan['Plan'])),
+        }
+
+    def scans(self, node):
+        found = set()
+        if 'Relation Name' in node:
+            found.add(f'{node["Node Type"]}:{node["Relation Name"]}')
+        for child in node.get('Plans', ()):
+            found |= self.scans(child)
+        return found
+
+    def regressions(self, plans, baseline):
+        for name, plan in plans.items():
+            previous = baseline.get(name)
+            if previous is None:
+                continue
+            for scan in set(plan['scans']) - set(previous['scans']):
+                if scan.startswith('Seq Scan:'):
+                    yield f'{name}: появился {scan}'
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            self.cleanup()
+            return
+        self.random = random.Random(options['seed'])
+        if options['recipes']:
+            self.seed(options['recipes'])
+        try:
+            plans = {
+                name: self.explain(queryset, options['analyze'])
+                for name, queryset in self.queries()
+            }
+        finally:
+            if options['recipes'] and not options['keep']:
+                self.cleanup()
+        for name, plan in plans.items():
+            self.stdout.write(f'{name}: {", ".join(plan["scans"]) or "-"}')
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(plans, file, ensure_ascii=False, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                found = list(self.regressions(plans, json.load(file)))
+            for line in found:
+                self.stderr.write(line)
+            if found:
+                raise CommandError(f'Регрессий индексов: {len(found)}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Записано планов: {len(plans)}'
+        ))
@@ -0,0 +1,44 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bulk import RecipeExporter
+
+
+class Command(BaseCommand):
+    help = "Exporting recipes to an NDJSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            type=str,
+            help='Путь до NDJSON-файла или - для вывода в stdout'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Количество рецептов в одном запросе'
+        )
+        parser.add_argument(
+            '--inline-images',
+            action='store_true',
+            help='Встраивать изображения в base64'
+        )
+
+    def handle(self, *args, **options):
+        exporter = RecipeExporter(
+            batch_size=options['batch_size'],
+            inline_images=options['inline_images']
+        )
+        if options['path'] == '-':
+            for chunk in exporter.stream():
+                sys.stdout.buffer.write(chunk)
+            return
+        try:
+            with open(options['path'], 'wb') as file:
+                for chunk in exporter.stream():
+                    file.write(chunk)
+        except OSError as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS('Рецепты выгружены'))
@@ -1,35 +1,59 @@
-import csv
 import os
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from recipes.models import Ingredient
+from recipes.importers import IngredientImporter
 
 
 class Command(BaseCommand):
-    help = "Filling ingredients with prepared CSV-files."
-    data_folder = "static/data"
-    schema = (
-        (Ingredient, "ingredients.csv"),
-    )
+    help = "Filling ingredients with prepared CSV or JSON files."
+    default_file = 'ingredients.csv'
 
     def add_arguments(self, parser):
         parser.add_argument(
             'path',
             type=str,
-            help='Путь до файла ингредиентов'
+            help='Путь до файла ингредиентов или до папки с ingredients.csv'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество строк в одной пачке'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Показать изменения без записи в базу'
+        )
+
+    def report(self, stats):
+        rate = stats['rows'] / stats['elapsed'] if stats['elapsed'] else 0
+        self.stdout.write(
+            f'Обработано строк: {stats["rows"]}, '
+            f'новых: {stats["created"]}, '
+            f'уже есть: {stats["existing"]}, '
+            f'повторов: {stats["duplicates"]}, '
+            f'ошибок: {stats["invalid"]} '
+            f'({rate:.0f} строк/с)'
         )
 
     def handle(self, *args, **options):
-        with open(
-            os.path.join(
-                options.get('path', ''),
-                'ingredients.csv'
-            ),
-            encoding="UTF-8"
-        ) as file:
-            reader = csv.reader(file)
-            result = [Ingredient(
-                name=name, measurement_unit=unit
-            ) for name, unit in reader]
-        Ingredient.objects.bulk_create(result)
+        path = options['path']
+        if os.path.isdir(path):
+            path = os.path.join(path, self.default_file)
+        importer = IngredientImporter(
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            report=self.report
+        )
+        try:
+            importer.import_file(path)
+        except (OSError, ValueError) as error:
+            raise CommandError(error)
+        if options['dry_run']:
+            self.stdout.write('Будут добавлены, например:')
+            for name, unit in importer.created_sample:
+                self.stdout.write(f'+ {name} ({unit})')
+            return
+        self.stdout.write(self.style.SUCCESS('Ингредиенты загружены'))
@@ -0,0 +1,212 @@
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.models import (
+    DataVersion, FavoriteRecipes, Ingredient, Recipe, RecipeIngredients,
+    RecipeScore, ShopCart, Tag, tags_mask
+)
+from users.models import Subscription
+
+User = get_user_model()
+TAGS = (
+    ('Завтрак', '#E26C2D', 'breakfast'),
+    ('Обед', '#49B64E', 'lunch'),
+    ('Ужин', '#8775D2', 'dinner'),
+)
+UNITS = ('г', 'мл', 'шт.', 'ст. л.', 'ч. л.', 'по вкусу')
+
+
+class Command(BaseCommand):
+    help = "Generating a large seeded dataset for load tests."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help='Количество пользователей'
+        )
+        parser.add_argument(
+            '--recipes', type=int, default=10000,
+            help='Количество рецептов'
+        )
+        parser.add_argument(
+            '--ingredients', type=int, default=2000,
+            help='Минимальное количество ингредиентов в справочнике'
+        )
+        parser.add_argument(
+            '--favorites', type=int, default=20,
+            help='Среднее число избранных рецептов у пользователя'
+        )
+        parser.add_argument(
+            '--carts', type=int, default=5,
+            help='Среднее число рецептов в списке покупок'
+        )
+        parser.add_argument(
+            '--subscriptions', type=int, default=10,
+            help='Среднее число подписок у пользователя'
+        )
+        parser.add_argument(
+            '--prefix', default='load',
+            help='Префикс имён создаваемых пользователей и рецептов'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=42,
+            help='Зерно генератора для повторяемых наборов данных'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Количество строк в одной пачке'
+        )
+
+    def bulk_create(self, model, rows):
+        rows = iter(rows)
+        while True:
+            batch = [row for _, row in zip(range(self.batch_size), rows)]
+            if not batch:
+                return
+            model.objects.bulk_create(batch, ignore_conflicts=True)
+
+    def create_tags(self):
+        if not Tag.objects.exists():
+            Tag.objects.bulk_create(
+                Tag(name=name, color=color, slug=slug)
+                for name, color, slug in TAGS
+            )
+        return list(Tag.objects.order_by('pk').values_list('pk', flat=True))
+
+    def create_ingredients(self, count):
+        missing = count - Ingredient.objects.count()
+        if missing > 0:
+            # bulk_create не вызывает save(), поэтому имя для поиска
+            # заполняем сами.
+            self.bulk_create(Ingredient, (
+                Ingredient(
+                    name=name,
+                    search_name=name.casefold(),
+                    measurement_unit=self.random.choice(UNITS)
+                )
+                for name in (
+                    f'{self.prefix} ингредиент {index}'
+                    for index in range(missing)
+                )
+            ))
+            DataVersion.objects.bump('ingredients')
+        return list(
+            Ingredient.objects.order_by('pk').values_list('pk', flat=True)
+        )
+
+    def create_users(self, count):
+        password = make_password(self.prefix)
+        self.bulk_create(User, (
+            User(
+                username=f'{self.prefix}_{index}',
+                email=f'{self.prefix}_{index}@example.com',
+                first_name='Пользователь',
+                last_name=str(index),
+                password=password
+            )
+            for index in range(count)
+        ))
+        return list(User.objects.filter(
+            username__startswith=f'{self.prefix}_'
+        ).order_by('pk').values_list('pk', flat=True))
+
+    def create_recipes(self, count, users, tags):
+        recipe_tags = [
+            self.random.sample(tags, self.random.randint(1, len(tags)))
+            for _ in range(count)
+        ]
+        self.bulk_create(Recipe, (
+            Recipe(
+                author_id=self.random.choice(users),
+                name=f'{self.prefix} рецепт {index}',
+                image='recipe/images/load.png',
+                description=f'{self.prefix} описание рецепта {index}',
+                cooking_time=self.random.randint(1, 180),
+                tags_mask=tags_mask(recipe_tags[index])
+            )
+            for index in range(count)
+        ))
+        recipes = list(Recipe.objects.filter(
+            author__in=users
+        ).order_by('pk').values_list('pk', flat=True))
+        RecipeTags = Recipe.tags.through
+        self.bulk_create(RecipeTags, (
+            RecipeTags(recipe_id=recipe, tag_id=tag)
+            for recipe, tag_ids in zip(recipes, recipe_tags)
+            for tag in tag_ids
+        ))
+        self.bulk_create(RecipeScore, (
+            RecipeScore(recipe_id=recipe) for recipe in recipes
+        ))
+        return recipes
+
+    def create_recipe_ingredients(self, recipes, ingredients):
+        self.bulk_create(RecipeIngredients, (
+            RecipeIngredients(
+                recipe_id=recipe,
+                ingredient_id=ingredient,
+                amount=self.random.randint(1, 500)
+            )
+            for recipe in recipes
+            for ingredient in self.random.sample(
+                ingredients, min(len(ingredients), self.random.randint(5, 20))
+            )
+        ))
+
+    def pairs(self, users, targets, average, exclude_self=False):
+        for user in users:
+            size = min(len(targets), self.random.randint(0, 2 * average))
+            for target in self.random.sample(targets, size):
+                if not exclude_self or target != user:
+                    yield user, target
+
+    def create_relations(self, options, users, recipes):
+        self.bulk_create(FavoriteRecipes, (
+            FavoriteRecipes(user_id=user, recipe_id=recipe)
+            for user, recipe in self.pairs(
+                users, recipes, options['favorites']
+            )
+        ))
+        self.bulk_create(ShopCart, (
+            ShopCart(user_id=user, recipe_id=recipe)
+            for user, recipe in self.pairs(users, recipes, options['carts'])
+        ))
+        self.bulk_create(Subscription, (
+            Subscription(subscriber_id=user, author_id=author)
+            for user, author in self.pairs(
+                users, users, options['subscriptions'], exclude_self=True
+            )
+        ))
+
+    def handle(self, *args, **options):
+        self.prefix = options['prefix']
+        self.batch_size = options['batch_size']
+        self.random = random.Random(options['seed'])
+        if User.objects.filter(
+            username__startswith=f'{self.prefix}_'
+        ).exists():
+            raise CommandError(
+                f'Данные с префиксом {self.prefix} уже созданы'
+            )
+        with transaction.atomic():
+            tags = self.create_tags()
+            ingredients = self.create_ingredients(options['ingredients'])
+            users = self.create_users(options['users'])
+            self.stdout.write(f'Создано пользователей: {len(users)}')
+            recipes = self.create_recipes(options['recipes'], users, tags)
+            self.stdout.write(f'Создано рецептов: {len(recipes)}')
+            self.create_recipe_ingredients(recipes, ingredients)
+            self.create_relations(options, users, recipes)
+        # Счётчики, списки покупок и индексы считаются теми же командами,
+        # что и в эксплуатации.
+        call_command('reconcile_counters')
+        call_command('rebuild_shopping_lists')
+        call_command('refresh_recipe_scores', full=True)
+        call_command('build_recipe_vectors')
+        call_command('rebuild_recipe_search')
+        self.stdout.write(self.style.SUCCESS('Тестовые данные созданы'))
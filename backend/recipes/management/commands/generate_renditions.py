@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+
+from recipes.images import generate_renditions
+from recipes.models import Recipe, RecipeImageRendition
+
+
+class Command(BaseCommand):
+    help = "Generating missing image renditions for recipes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Пересоздать варианты для всех рецептов'
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.exclude(image='')
+        if not options['all']:
+            recipes = recipes.annotate(has_renditions=Exists(
+                RecipeImageRendition.objects.filter(
+                    recipe=OuterRef('pk'), source=OuterRef('image')
+                )
+            )).filter(has_renditions=False)
+        count = 0
+        for recipe_id in recipes.values_list('pk', flat=True).iterator():
+            try:
+                generate_renditions(recipe_id)
+            except (OSError, ValueError) as error:
+                self.stderr.write(f'Рецепт {recipe_id}: {error}')
+                continue
+            count += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано рецептов: {count}'
+        ))
@@ -0,0 +1,70 @@
+import json
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bulk import RecipeImporter
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Importing recipes from an NDJSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str, help='Путь до NDJSON-файла')
+        parser.add_argument(
+            '--author',
+            required=True,
+            help='Имя пользователя, от которого создаются рецепты'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Количество рецептов в одной транзакции'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Имя позиции для продолжения импорта, по умолчанию путь '
+                 'до файла'
+        )
+
+    def report(self, stats):
+        rate = stats['rows'] / stats['elapsed'] if stats['elapsed'] else 0
+        self.stdout.write(
+            f'Обработано строк: {stats["rows"]}, '
+            f'создано: {stats["created"]}, '
+            f'ошибок: {stats["invalid"]} '
+            f'({rate:.0f} строк/с)'
+        )
+
+    def handle(self, *args, **options):
+        author = User.objects.filter(username=options['author']).first()
+        if author is None:
+            raise CommandError(f'Пользователь {options["author"]} не найден')
+        importer = RecipeImporter(
+            author,
+            batch_size=options['batch_size'],
+            checkpoint=(
+                options['checkpoint'] or os.path.abspath(options['path'])
+            ),
+            report=self.report
+        )
+        if importer.position:
+            self.stdout.write(
+                f'Продолжение со строки {importer.position + 1}'
+            )
+        try:
+            with open(options['path'], 'rb') as file:
+                importer.import_rows(file)
+        except OSError as error:
+            raise CommandError(error)
+        for error in importer.errors:
+            self.stderr.write(
+                f'Строка {error["line"]}: '
+                + json.dumps(error['errors'], ensure_ascii=False)
+            )
+        importer.finish()
+        self.stdout.write(self.style.SUCCESS('Рецепты загружены'))
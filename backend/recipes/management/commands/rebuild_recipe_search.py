@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from api.search import get_recipe_search
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = "Rebuilding the recipe full-text search index."
+
+    def handle(self, *args, **options):
+        get_recipe_search().index(Recipe.objects.all())
+        self.stdout.write(self.style.SUCCESS('Поисковый индекс обновлён'))
@@ -0,0 +1,88 @@
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from recipes.models import RecipeIngredients, ShopCartIngredient
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Rebuilding shopping lists from shopping carts."
+    batch_size = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сравнить списки покупок с корзинами'
+        )
+
+    def live_totals(self):
+        rows = RecipeIngredients.objects.filter(
+            recipe__in_shopping_cart__isnull=False
+        ).values_list(
+            'recipe__in_shopping_cart__user', 'ingredient'
+        ).annotate(
+            amount=Sum('amount'), entries=Count('id')
+        ).order_by()
+        return {
+            (user_id, ingredient_id): (amount, entries)
+            for user_id, ingredient_id, amount, entries in rows.iterator()
+        }
+
+    def stored_totals(self):
+        rows = ShopCartIngredient.objects.values_list(
+            'user_id', 'ingredient_id', 'amount', 'entries'
+        )
+        return {
+            (user_id, ingredient_id): (amount, entries)
+            for user_id, ingredient_id, amount, entries in rows.iterator()
+        }
+
+    @transaction.atomic
+    def rebuild(self, totals):
+        ShopCartIngredient.objects.all().delete()
+        rows = (
+            ShopCartIngredient(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                amount=amount,
+                entries=entries
+            )
+            for (user_id, ingredient_id), (amount, entries) in totals.items()
+        )
+        # Явный batch_size в bulk_create обходит ограничение SQLite
+        # на размер запроса, поэтому пачки нарезаются вручную.
+        batch = list(islice(rows, self.batch_size))
+        while batch:
+            ShopCartIngredient.objects.bulk_create(batch)
+            batch = list(islice(rows, self.batch_size))
+        User.objects.touch_cart()
+
+    def handle(self, *args, **options):
+        live = self.live_totals()
+        if not options['check']:
+            self.rebuild(live)
+            self.stdout.write(f'Записано строк: {len(live)}')
+        stored = self.stored_totals()
+        drift = {
+            key for key in live.keys() | stored.keys()
+            if live.get(key) != stored.get(key)
+        }
+        if drift:
+            for user_id, ingredient_id in sorted(drift)[:20]:
+                self.stderr.write(
+                    f'user={user_id} ingredient={ingredient_id}: '
+                    f'ожидалось {live.get((user_id, ingredient_id))}, '
+                    f'записано {stored.get((user_id, ingredient_id))}'
+                )
+            raise CommandError(
+                f'Расхождений со списками покупок: {len(drift)}'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Списки покупок совпадают с корзинами'
+        ))
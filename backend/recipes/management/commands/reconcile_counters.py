@@ -0,0 +1,66 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import FavoriteRecipes, Recipe, ShopCart
+from users.models import Subscription
+
+User = get_user_model()
+COUNTERS = (
+    (Recipe, 'favorites_count', FavoriteRecipes, 'recipe'),
+    (Recipe, 'cart_count', ShopCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'subscribers_count', Subscription, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = "Reconciling denormalized counters with related rows."
+    batch_size = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только сравнить счётчики с фактическими значениями'
+        )
+
+    def drift(self, model, field, related, related_field):
+        actual = related.objects.filter(
+            **{related_field: OuterRef('pk')}
+        ).order_by().values(related_field).annotate(
+            total=Count('pk')
+        ).values('total')
+        return model.objects.annotate(
+            actual=Coalesce(Subquery(actual), 0)
+        ).exclude(**{field: F('actual')}).values_list(
+            'pk', field, 'actual'
+        )
+
+    @transaction.atomic
+    def repair(self, model, field, rows):
+        model.objects.bulk_update(
+            [model(pk=pk, **{field: actual}) for pk, _, actual in rows],
+            [field],
+            batch_size=self.batch_size
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        for model, field, related, related_field in COUNTERS:
+            rows = list(self.drift(model, field, related, related_field))
+            total += len(rows)
+            label = f'{model._meta.model_name}.{field}'
+            for pk, stored, actual in rows[:20]:
+                self.stderr.write(
+                    f'{label} id={pk}: записано {stored}, '
+                    f'ожидалось {actual}'
+                )
+            if rows and not options['check']:
+                self.repair(model, field, rows)
+                self.stdout.write(f'{label}: исправлено {len(rows)}')
+        if total and options['check']:
+            raise CommandError(f'Расхождений в счётчиках: {total}')
+        self.stdout.write(self.style.SUCCESS('Счётчики согласованы'))
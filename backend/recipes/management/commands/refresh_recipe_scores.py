@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import response_cache
+from recipes.scores import refresh_scores
+
+
+class Command(BaseCommand):
+    help = "Refreshing popularity scores of recipes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Пересчитать рейтинги всех рецептов'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество рецептов в одной транзакции'
+        )
+
+    def handle(self, *args, **options):
+        refreshed = refresh_scores(
+            full=options['full'], batch_size=options['batch_size']
+        )
+        if refreshed:
+            response_cache.invalidate({
+                'recipes:ordering:popular', 'recipes:ordering:trending'
+            })
+        self.stdout.write(self.style.SUCCESS(
+            f'Обновлено рейтингов: {refreshed}'
+        ))
@@ -0,0 +1,52 @@
+from django.db import migrations
+from django.db.models import Count, F, Min
+
+
+def merge_rows(model, owner, fields, duplicate, survivor):
+    # Строки дубликата переносим на оставшийся ингредиент, а если у
+    # владельца он уже есть - складываем количества.
+    for row in model.objects.filter(ingredient_id=duplicate):
+        merged = model.objects.filter(
+            **{owner: getattr(row, owner)}, ingredient_id=survivor
+        ).update(**{
+            field: F(field) + getattr(row, field) for field in fields
+        })
+        if merged:
+            row.delete()
+        else:
+            row.ingredient_id = survivor
+            row.save(update_fields=['ingredient'])
+
+
+def merge_duplicates(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    RecipeIngredients = apps.get_model('recipes', 'RecipeIngredients')
+    ShopCartIngredient = apps.get_model('recipes', 'ShopCartIngredient')
+    groups = Ingredient.objects.order_by().values(
+        'name', 'measurement_unit'
+    ).annotate(survivor=Min('pk'), rows=Count('pk')).filter(rows__gt=1)
+    for group in groups:
+        duplicates = list(Ingredient.objects.filter(
+            name=group['name'], measurement_unit=group['measurement_unit']
+        ).exclude(pk=group['survivor']).values_list('pk', flat=True))
+        for duplicate in duplicates:
+            merge_rows(
+                RecipeIngredients, 'recipe_id', ('amount',),
+                duplicate, group['survivor']
+            )
+            merge_rows(
+                ShopCartIngredient, 'user_id', ('amount', 'entries'),
+                duplicate, group['survivor']
+            )
+        Ingredient.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_schema'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
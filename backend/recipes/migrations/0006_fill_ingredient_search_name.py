@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def fill_search_name(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    ingredients = []
+    for ingredient in Ingredient.objects.only('name').iterator():
+        ingredient.search_name = ingredient.name.casefold()
+        ingredients.append(ingredient)
+    Ingredient.objects.bulk_update(
+        ingredients, ['search_name'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_unique_ingredient'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_search_name, migrations.RunPython.noop),
+    ]
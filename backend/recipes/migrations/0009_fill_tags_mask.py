@@ -0,0 +1,34 @@
+from itertools import groupby
+from operator import itemgetter
+
+from django.db import migrations
+
+
+def fill_tags_mask(apps, schema_editor):
+    # Повторяет recipes.models.tags_mask: теги с id больше 63 в маску не
+    # помещаются, у таких рецептов маска остаётся пустой.
+    Recipe = apps.get_model('recipes', 'Recipe')
+    rows = Recipe.tags.through.objects.order_by('recipe').values_list(
+        'recipe', 'tag'
+    )
+    recipes = []
+    for pk, tag_ids in groupby(rows.iterator(), key=itemgetter(0)):
+        mask = 0
+        for _, tag_id in tag_ids:
+            if not 1 <= tag_id <= 63:
+                mask = None
+                break
+            mask |= 1 << (tag_id - 1)
+        recipes.append(Recipe(pk=pk, tags_mask=mask))
+    Recipe.objects.bulk_update(recipes, ['tags_mask'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_recipe_search_vector_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_tags_mask, migrations.RunPython.noop),
+    ]
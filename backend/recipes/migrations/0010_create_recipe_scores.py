@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def create_scores(apps, schema_editor):
+    # Популярность считается по весам по умолчанию; счётчики в строке
+    # рейтинга остаются нулевыми, поэтому следующий refresh_recipe_scores
+    # пересчитает такие рецепты полностью.
+    Recipe = apps.get_model('recipes', 'Recipe')
+    RecipeScore = apps.get_model('recipes', 'RecipeScore')
+    rows = Recipe.objects.filter(score__isnull=True).values_list(
+        'pk', 'favorites_count', 'cart_count'
+    )
+    RecipeScore.objects.bulk_create([
+        RecipeScore(recipe_id=pk, popular=favorites * 2 + carts)
+        for pk, favorites, carts in rows.iterator()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_fill_tags_mask'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+from array import array
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def pack_ids(ids):
+    return array('I', sorted(set(ids))).tobytes()
+
+
+def fill_vectors(apps, schema_editor):
+    # Векторы нужны индексам похожих и доступных рецептов; дальше их
+    # поддерживают сигналы.
+    Recipe = apps.get_model('recipes', 'Recipe')
+    RecipeIngredients = apps.get_model('recipes', 'RecipeIngredients')
+    RecipeVector = apps.get_model('recipes', 'RecipeVector')
+    ids = list(Recipe.objects.filter(vector__isnull=True).order_by(
+        'pk'
+    ).values_list('pk', flat=True))
+    for start in range(0, len(ids), 1000):
+        batch = ids[start:start + 1000]
+        ingredients = defaultdict(list)
+        for recipe_id, ingredient_id in RecipeIngredients.objects.filter(
+            recipe__in=batch
+        ).values_list('recipe_id', 'ingredient_id'):
+            ingredients[recipe_id].append(ingredient_id)
+        tags = defaultdict(list)
+        for recipe_id, tag_id in Recipe.tags.through.objects.filter(
+            recipe__in=batch
+        ).values_list('recipe_id', 'tag_id'):
+            tags[recipe_id].append(tag_id)
+        RecipeVector.objects.bulk_create([
+            RecipeVector(
+                recipe_id=pk,
+                ingredients=pack_ids(ingredients[pk]),
+                tags=pack_ids(tags[pk])
+            )
+            for pk in batch
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_create_recipe_scores'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_fill_recipe_vectors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Источник импорта')),
+                ('position', models.PositiveIntegerField(default=0, verbose_name='Обработано строк')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Изменена')),
+            ],
+            options={
+                'verbose_name': 'Позиция импорта',
+                'verbose_name_plural': 'Позиции импорта',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    # Триграммы есть только в PostgreSQL, на других базах поиск по
+    # триграммам не включается.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS ingredient_search_name_trgm_idx '
+        'ON recipes_ingredient USING gin (search_name gin_trgm_ops)'
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS ingredient_search_name_trgm_idx'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0012_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
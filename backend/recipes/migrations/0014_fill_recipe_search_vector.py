@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_search_vector(apps, schema_editor):
+    # Вектор поиска есть только в PostgreSQL; у новых и изменённых
+    # рецептов его заполняют сигналы, здесь - у уже существующих.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from django.contrib.postgres.aggregates import StringAgg
+    from django.contrib.postgres.search import SearchVector
+
+    Recipe = apps.get_model('recipes', 'Recipe')
+    RecipeIngredients = apps.get_model('recipes', 'RecipeIngredients')
+    config = getattr(settings, 'RECIPE_SEARCH', {}).get('CONFIG', 'russian')
+    ingredients = RecipeIngredients.objects.filter(
+        recipe=OuterRef('pk')
+    ).order_by().values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' ')
+    ).values('names')
+    vector = (
+        SearchVector('name', weight='A', config=config)
+        + SearchVector('description', weight='B', config=config)
+        + SearchVector(
+            Coalesce(
+                Subquery(ingredients, output_field=TextField()), Value('')
+            ),
+            weight='C',
+            config=config
+        )
+    )
+    ids = list(Recipe.objects.filter(search_vector__isnull=True).order_by(
+        'pk'
+    ).values_list('pk', flat=True))
+    for start in range(0, len(ids), 1000):
+        Recipe.objects.filter(
+            pk__in=ids[start:start + 1000]
+        ).update(search_vector=vector)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_ingredient_trigram_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_search_vector, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,118 @@
+from array import array
+from itertools import groupby
+from operator import itemgetter
+
 from colorfield.fields import ColorField
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (
+    BooleanField, Case, Exists, F, IntegerField, OuterRef, Prefetch, Value,
+    When, Window
+)
+from django.db.models.functions import Greatest, RowNumber
+from django.utils import timezone
+
+from .storage import ContentAddressedStorage
 
 User = get_user_model()
+media_storage = ContentAddressedStorage()
+
+
+class MediaFileQuerySet(models.QuerySet):
+    def register(self, name):
+        if not self.filter(name=name).update(updated=timezone.now()):
+            self.get_or_create(name=name)
+
+    def adjust(self, names, delta):
+        for name in names:
+            if not name:
+                continue
+            if not self.filter(name=name).update(
+                references=F('references') + delta,
+                updated=timezone.now()
+            ):
+                self.get_or_create(
+                    name=name, defaults={'references': max(delta, 0)}
+                )
+
+    def acquire(self, names):
+        self.adjust(names, 1)
+
+    def release(self, names):
+        self.adjust(names, -1)
+
+
+class MediaFile(models.Model):
+    name = models.CharField('Путь к файлу', max_length=255, unique=True)
+    references = models.IntegerField('Количество ссылок', default=0)
+    updated = models.DateTimeField('Изменён', default=timezone.now)
+
+    objects = MediaFileQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Медиафайл'
+        verbose_name_plural = 'Медиафайлы'
+        indexes = [
+            models.Index(
+                fields=['references', 'updated'],
+                name='mediafile_references_idx'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.name} ({self.references})'
+
+
+class DataVersionQuerySet(models.QuerySet):
+    def get_version(self, name):
+        return self.filter(name=name).values_list(
+            'version', flat=True
+        ).first() or 0
+
+    def bump(self, name):
+        if not self.filter(name=name).update(version=F('version') + 1):
+            self.get_or_create(name=name, defaults={'version': 1})
+
+
+class DataVersion(models.Model):
+    name = models.CharField('Набор данных', max_length=50, unique=True)
+    version = models.PositiveIntegerField('Версия', default=0)
+
+    objects = DataVersionQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+
+class ImportCheckpointQuerySet(models.QuerySet):
+    def get_position(self, name):
+        return self.filter(name=name).values_list(
+            'position', flat=True
+        ).first() or 0
+
+    def save_position(self, name, position):
+        self.update_or_create(name=name, defaults={'position': position})
+
+
+class ImportCheckpoint(models.Model):
+    name = models.CharField('Источник импорта', max_length=255, unique=True)
+    position = models.PositiveIntegerField('Обработано строк', default=0)
+    updated = models.DateTimeField('Изменена', auto_now=True)
+
+    objects = ImportCheckpointQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Позиция импорта'
+        verbose_name_plural = 'Позиции импорта'
+
+    def __str__(self):
+        return f'{self.name}: {self.position}'
 
 
 class Tag(models.Model):
@@ -43,25 +152,122 @@ class Ingredient(models.Model):
         db_index=True
     )
     measurement_unit = models.CharField('Единица измерения', max_length=50)
+    search_name = models.CharField(
+        'Название для поиска',
+        max_length=256,
+        db_index=True,
+        editable=False
+    )
 
     class Meta:
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
         ordering = ('name',)
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'measurement_unit'],
+                name='unique_ingredient_name_unit'
+            )
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.search_name = self.name.casefold()
+        super().save(*args, **kwargs)
+
+
+def tags_mask(tag_ids):
+    # Битовая маска помещается в BIGINT только для тегов с id от 1 до 63.
+    mask = 0
+    for pk in tag_ids:
+        if not 1 <= pk <= 63:
+            return None
+        mask |= 1 << (pk - 1)
+    return mask
+
+
+class RecipeQuerySet(models.QuerySet):
+    def with_user_flags(self, user):
+        if not user.is_authenticated:
+            return self.annotate(
+                is_favorited=Value(False, output_field=BooleanField()),
+                is_in_shopping_cart=Value(False, output_field=BooleanField())
+            )
+        return self.annotate(
+            is_favorited=Exists(FavoriteRecipes.objects.filter(
+                recipe=OuterRef('pk'), user=user
+            )),
+            is_in_shopping_cart=Exists(ShopCart.objects.filter(
+                recipe=OuterRef('pk'), user=user
+            ))
+        )
+
+    def with_related(self, user):
+        return self.prefetch_related(
+            Prefetch(
+                'author',
+                queryset=User.objects.with_subscription_flag(user)
+            ),
+            Prefetch('tags', queryset=Tag.objects.all()),
+            'renditions',
+            Prefetch(
+                'recipeingredients_set',
+                queryset=RecipeIngredients.objects.select_related(
+                    'ingredient'
+                )
+            )
+        )
+
+    def adjust_counters(self, pk, **deltas):
+        # Счётчик не уходит ниже нуля, даже если разошёлся со строками.
+        return self.filter(pk=pk).update(**{
+            field: Greatest(F(field) + delta, 0)
+            for field, delta in deltas.items()
+        })
+
+    def refresh_tags_mask(self):
+        for pk, tag_ids in groupby(
+            self.model.tags.through.objects.filter(
+                recipe__in=self
+            ).order_by('recipe').values_list('recipe', 'tag'),
+            key=itemgetter(0)
+        ):
+            mask = tags_mask(tag_id for _, tag_id in tag_ids)
+            self.model.objects.filter(pk=pk).update(tags_mask=mask)
+        self.filter(tags=None).update(tags_mask=0)
+
+    def first_per_author(self, authors, limit):
+        ranked = self.filter(author__in=authors).annotate(
+            position=Window(
+                expression=RowNumber(),
+                partition_by=[F('author')],
+                order_by=[F('pub_date').desc(), F('id').desc()]
+            )
+        ).order_by().values('pk', 'position')
+        sql, params = ranked.query.sql_with_params()
+        return self.extra(
+            where=[
+                f'"{self.model._meta.db_table}"."id" IN ('
+                f'SELECT "id" FROM ({sql}) ranked WHERE "position" <= %s)'
+            ],
+            params=(*params, limit)
+        )
+
 
 class Recipe(models.Model):
     author = models.ForeignKey(
         User,
         verbose_name='Автор рецепта',
         on_delete=models.CASCADE,
-        related_name='recipes'
+        related_name='recipes',
+        db_index=False
     )
     name = models.CharField('Название рецепта', max_length=256, db_index=True)
-    image = models.ImageField(upload_to='recipe/images')
+    image = models.ImageField(
+        upload_to='recipe/images', storage=media_storage
+    )
     description = models.TextField('Описание рецепта', max_length=2500)
     ingredients = models.ManyToManyField(
         Ingredient,
@@ -73,22 +279,139 @@ class Recipe(models.Model):
         'Время приготовления в минутах',
         validators=[MinValueValidator(1, message='Минимальное значение 1!')]
     )
-    pub_date = models.DateTimeField(auto_now_add=True, db_index=True)
+    pub_date = models.DateTimeField(auto_now_add=True)
+    favorites_count = models.PositiveIntegerField(
+        'Добавлений в избранное', default=0, editable=False
+    )
+    cart_count = models.PositiveIntegerField(
+        'Добавлений в корзину', default=0, editable=False
+    )
+    tags_mask = models.BigIntegerField(
+        'Битовая маска тегов', null=True, default=0, editable=False
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-pub_date',)
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_idx'
+            ),
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='recipe_author_pub_date_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
 
+class RecipeImageRendition(models.Model):
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='renditions'
+    )
+    source = models.CharField('Исходное изображение', max_length=255)
+    name = models.CharField('Вариант', max_length=20)
+    image_format = models.CharField('Формат', max_length=10)
+    width = models.PositiveIntegerField('Ширина')
+    height = models.PositiveIntegerField('Высота')
+    image = models.ImageField(
+        upload_to='recipe/renditions', storage=media_storage
+    )
+
+    class Meta:
+        verbose_name = 'Вариант изображения'
+        verbose_name_plural = 'Варианты изображений'
+        ordering = ('width',)
+
+    def __str__(self):
+        return f'{self.recipe} {self.name}.{self.image_format}'
+
+
+class RecipeScore(models.Model):
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='score'
+    )
+    popular = models.FloatField('Популярность', default=0)
+    trending = models.FloatField('Популярность за последнее время', default=0)
+    favorites_count = models.PositiveIntegerField(default=0)
+    cart_count = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = 'Рейтинг рецепта'
+        verbose_name_plural = 'Рейтинги рецептов'
+        indexes = [
+            models.Index(
+                fields=['-popular', '-recipe'],
+                name='recipescore_popular_idx'
+            ),
+            models.Index(
+                fields=['-trending', '-recipe'],
+                name='recipescore_trending_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe_id}: {self.popular:.1f} / {self.trending:.1f}'
+
+
+class RecipeIngredientsQuerySet(models.QuerySet):
+    @transaction.atomic
+    def sync(self, recipe, amounts):
+        rows = {
+            row.ingredient_id: row
+            for row in self.filter(recipe=recipe).select_for_update()
+        }
+        old_amounts = {
+            ingredient_id: row.amount for ingredient_id, row in rows.items()
+        }
+        deleted = [
+            row.pk for ingredient_id, row in rows.items()
+            if ingredient_id not in amounts
+        ]
+        changed = []
+        for ingredient_id, row in rows.items():
+            amount = amounts.get(ingredient_id, row.amount)
+            if amount != row.amount:
+                row.amount = amount
+                changed.append(row)
+        created = [
+            self.model(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount
+            )
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in rows
+        ]
+        # Как и bulk_update с bulk_create, удаление идёт без сигналов по
+        # строкам: вызывающий код обрабатывает изменения рецепта целиком.
+        if deleted:
+            self.filter(pk__in=deleted)._raw_delete(self.db)
+        if changed:
+            self.bulk_update(changed, ['amount'])
+        if created:
+            self.bulk_create(created)
+        return old_amounts, len(deleted) + len(changed) + len(created)
+
+
 class RecipeIngredients(models.Model):
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
     ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE)
     amount = models.PositiveSmallIntegerField()
 
+    objects = RecipeIngredientsQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Количество ингредиента'
         verbose_name_plural = 'Количество ингредиентов'
@@ -100,7 +423,101 @@ class RecipeIngredients(models.Model):
         ]
 
 
+def pack_ids(ids):
+    return array('I', sorted(set(ids))).tobytes()
+
+
+class RecipeVectorQuerySet(models.QuerySet):
+    def features(self, ids, queryset, field):
+        rows = queryset.filter(recipe__in=ids).order_by(
+            'recipe_id'
+        ).values_list('recipe_id', field)
+        return {
+            recipe_id: [value for _, value in group]
+            for recipe_id, group in groupby(rows, key=itemgetter(0))
+        }
+
+    @transaction.atomic
+    def rebuild(self, ids):
+        ids = list(Recipe.objects.filter(pk__in=ids).values_list(
+            'pk', flat=True
+        ))
+        ingredients = self.features(
+            ids, RecipeIngredients.objects, 'ingredient_id'
+        )
+        tags = self.features(ids, Recipe.tags.through.objects, 'tag_id')
+        vectors = {
+            pk: (pack_ids(ingredients.get(pk, ())), pack_ids(tags.get(pk, ())))
+            for pk in ids
+        }
+        stored = {
+            pk: (bytes(ingredient_ids), bytes(tag_ids))
+            for pk, ingredient_ids, tag_ids in self.filter(
+                recipe__in=ids
+            ).values_list('recipe_id', 'ingredients', 'tags')
+        }
+        # Переписываем только изменившиеся векторы, чтобы индексы
+        # похожих и доступных рецептов не перечитывали лишнего.
+        changed = [pk for pk in ids if stored.get(pk) != vectors[pk]]
+        if not changed:
+            return 0
+        self.filter(recipe__in=changed).delete()
+        self.bulk_create(
+            self.model(
+                recipe_id=pk,
+                ingredients=vectors[pk][0],
+                tags=vectors[pk][1]
+            )
+            for pk in changed
+        )
+        transaction.on_commit(
+            lambda: DataVersion.objects.bump('recipe_vectors')
+        )
+        return len(changed)
+
+    def changes(self, since, known):
+        # Векторы, изменённые начиная с since, и рецепты, пропавшие из
+        # known. Удаления ищутся только если не сходится число строк.
+        rows = self.all()
+        if since is not None:
+            rows = rows.filter(updated__gte=since)
+        changed = {
+            pk: (bytes(ingredients), bytes(tags))
+            for pk, ingredients, tags in rows.values_list(
+                'recipe_id', 'ingredients', 'tags'
+            ).iterator()
+        }
+        expected = len(known) + sum(pk not in known for pk in changed)
+        if since is None or self.count() == expected:
+            return changed, set()
+        existing = set(self.values_list('pk', flat=True))
+        return changed, {pk for pk in known if pk not in existing}
+
+
+class RecipeVector(models.Model):
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='vector'
+    )
+    ingredients = models.BinaryField('Ингредиенты')
+    tags = models.BinaryField('Теги')
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = RecipeVectorQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Вектор рецепта'
+        verbose_name_plural = 'Векторы рецептов'
+
+    def __str__(self):
+        return str(self.recipe_id)
+
+
 class FavoriteRecipes(models.Model):
+    counter_field = 'favorites_count'
+
     recipe = models.ForeignKey(
         Recipe,
         on_delete=models.CASCADE,
@@ -110,7 +527,11 @@ class FavoriteRecipes(models.Model):
         User,
         verbose_name='Пользователь',
         on_delete=models.CASCADE,
-        related_name='favorite_recipes'
+        related_name='favorite_recipes',
+        db_index=False
+    )
+    added = models.DateTimeField(
+        'Дата добавления', default=timezone.now, db_index=True
     )
 
     class Meta:
@@ -122,12 +543,19 @@ class FavoriteRecipes(models.Model):
                 name='unique_favoriterecipe_user'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['user', 'recipe'], name='favoriterecipe_user_idx'
+            )
+        ]
 
     def __str__(self):
         return f'{self.user} likes {self.recipe}'
 
 
 class ShopCart(models.Model):
+    counter_field = 'cart_count'
+
     recipe = models.ForeignKey(
         Recipe,
         on_delete=models.CASCADE,
@@ -137,7 +565,11 @@ class ShopCart(models.Model):
         User,
         verbose_name='Пользователь',
         on_delete=models.CASCADE,
-        related_name='shopping_cart'
+        related_name='shopping_cart',
+        db_index=False
+    )
+    added = models.DateTimeField(
+        'Дата добавления', default=timezone.now, db_index=True
     )
 
     class Meta:
@@ -149,6 +581,116 @@ class ShopCart(models.Model):
                 name='unique_cartrecipe_user'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['user', 'recipe'], name='cartrecipe_user_idx'
+            )
+        ]
 
     def __str__(self):
         return f'{self.user} byes {self.recipe}'
+
+
+class ShopCartIngredientQuerySet(models.QuerySet):
+    def add_recipe(self, user_ids, recipe):
+        self.apply_deltas(user_ids, self.recipe_deltas(recipe, 1))
+
+    def remove_recipe(self, user_ids, recipe):
+        self.apply_deltas(user_ids, self.recipe_deltas(recipe, -1))
+
+    def change_recipe(self, recipe, old_amounts, new_amounts):
+        deltas = {}
+        for ingredient_id in old_amounts.keys() | new_amounts.keys():
+            amount = (
+                new_amounts.get(ingredient_id, 0)
+                - old_amounts.get(ingredient_id, 0)
+            )
+            entries = (
+                (ingredient_id in new_amounts)
+                - (ingredient_id in old_amounts)
+            )
+            if amount or entries:
+                deltas[ingredient_id] = (amount, entries)
+        user_ids = ShopCart.objects.filter(
+            recipe=recipe
+        ).values_list('user_id', flat=True)
+        self.apply_deltas(list(user_ids), deltas)
+
+    def recipe_deltas(self, recipe, sign):
+        return {
+            ingredient_id: (sign * amount, sign)
+            for ingredient_id, amount in RecipeIngredients.objects.filter(
+                recipe=recipe
+            ).values_list('ingredient_id', 'amount')
+        }
+
+    def delta_case(self, deltas, index):
+        return Case(
+            *[When(ingredient_id=ingredient_id, then=Value(delta[index]))
+              for ingredient_id, delta in deltas.items()],
+            default=Value(0),
+            output_field=IntegerField()
+        )
+
+    @transaction.atomic
+    def apply_deltas(self, user_ids, deltas):
+        if not user_ids or not deltas:
+            return
+        rows = self.filter(user_id__in=user_ids, ingredient_id__in=deltas)
+        existing = set(rows.select_for_update().values_list(
+            'user_id', 'ingredient_id'
+        ))
+        now = timezone.now()
+        if existing:
+            rows.update(
+                amount=F('amount') + self.delta_case(deltas, 0),
+                entries=F('entries') + self.delta_case(deltas, 1),
+                updated=now
+            )
+        self.bulk_create([
+            self.model(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                amount=amount,
+                entries=entries,
+                updated=now
+            )
+            for user_id in user_ids
+            for ingredient_id, (amount, entries) in deltas.items()
+            if entries > 0 and (user_id, ingredient_id) not in existing
+        ])
+        rows.filter(entries__lte=0).delete()
+        User.objects.filter(pk__in=user_ids).touch_cart()
+
+
+class ShopCartIngredient(models.Model):
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        on_delete=models.CASCADE,
+        related_name='shopping_list'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        verbose_name='Ингредиент',
+        on_delete=models.CASCADE,
+        related_name='in_shopping_lists'
+    )
+    amount = models.IntegerField('Общее количество', default=0)
+    entries = models.IntegerField('Рецептов с ингредиентом', default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
+    objects = ShopCartIngredientQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Ингредиент в списке покупок'
+        verbose_name_plural = 'Список покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_shoppinglist_user_ingredient'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} - {self.amount}'
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+from math import log2
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+
+from .models import FavoriteRecipes, Recipe, RecipeScore, ShopCart
+
+DEFAULTS = {
+    'FAVORITE_WEIGHT': 2,
+    'CART_WEIGHT': 1,
+    'HALF_LIFE': timedelta(days=3),
+    'EPOCH': datetime(2021, 1, 1, tzinfo=dt_timezone.utc),
+    'OVERLAP': timedelta(minutes=5),
+}
+
+
+def get_score_settings():
+    return {**DEFAULTS, **getattr(settings, 'RECIPE_SCORES', {})}
+
+
+def decayed_score(events, options):
+    # Вклад события растёт как 2^(t / half_life), поэтому старые оценки
+    # не нужно пересчитывать со временем; храним логарифм суммы.
+    half_life = options['HALF_LIFE'].total_seconds()
+    exponents = [
+        (added - options['EPOCH']).total_seconds() / half_life + log2(weight)
+        for added, weight in events
+    ]
+    if not exponents:
+        return 0
+    top = max(exponents)
+    return top + log2(sum(2 ** (exponent - top) for exponent in exponents))
+
+
+def dirty_recipes(since):
+    if since is None:
+        return Recipe.objects.values_list('pk', flat=True).iterator()
+    recipes = Recipe.objects.filter(
+        Q(score__isnull=True)
+        | ~Q(score__favorites_count=F('favorites_count'))
+        | ~Q(score__cart_count=F('cart_count'))
+    ).values_list('pk', flat=True)
+    touched = set(FavoriteRecipes.objects.filter(
+        added__gte=since
+    ).values_list('recipe_id', flat=True))
+    touched.update(ShopCart.objects.filter(
+        added__gte=since
+    ).values_list('recipe_id', flat=True))
+    return set(recipes) | touched
+
+
+@transaction.atomic
+def refresh_batch(recipe_ids, options, now):
+    events = {pk: [] for pk in recipe_ids}
+    for model, weight in (
+        (FavoriteRecipes, options['FAVORITE_WEIGHT']),
+        (ShopCart, options['CART_WEIGHT']),
+    ):
+        for recipe_id, added in model.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values_list('recipe_id', 'added'):
+            events[recipe_id].append((added, weight))
+    counters = Recipe.objects.filter(pk__in=recipe_ids).values_list(
+        'pk', 'favorites_count', 'cart_count'
+    )
+    scores = [
+        RecipeScore(
+            recipe_id=pk,
+            popular=(
+                favorites * options['FAVORITE_WEIGHT']
+                + carts * options['CART_WEIGHT']
+            ),
+            trending=decayed_score(events[pk], options),
+            favorites_count=favorites,
+            cart_count=carts,
+            updated=now
+        )
+        for pk, favorites, carts in counters
+    ]
+    RecipeScore.objects.filter(recipe_id__in=recipe_ids).delete()
+    RecipeScore.objects.bulk_create(scores)
+    return len(scores)
+
+
+def refresh_scores(full=False, batch_size=1000):
+    options = get_score_settings()
+    now = timezone.now()
+    since = None
+    if not full:
+        last = RecipeScore.objects.aggregate(last=Max('updated'))['last']
+        if last is not None:
+            since = last - options['OVERLAP']
+    recipe_ids = iter(dirty_recipes(since))
+    refreshed = 0
+    batch = list(islice(recipe_ids, batch_size))
+    while batch:
+        refreshed += refresh_batch(batch, options, now)
+        batch = list(islice(recipe_ids, batch_size))
+    return refreshed
@@ -8,7 +8,7 @@ from .models import User, Subscription
 class CustomUserAdmin(UserAdmin):
     list_display = (
         'pk', 'username', 'email', 'first_name', 'last_name',
-        'is_active', 'is_staff',
+        'is_active', 'is_staff', 'recipes_count', 'subscribers_count',
     )
     search_fields = ('username', 'email')
     empty_value_display = '-пусто-'
@@ -1,7 +1,38 @@
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
-from django.db.models import Q, F
+from django.db.models import BooleanField, Exists, F, OuterRef, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+
+class UserQuerySet(models.QuerySet):
+    def with_subscription_flag(self, user):
+        if not user.is_authenticated:
+            return self.annotate(
+                is_subscribed=Value(False, output_field=BooleanField())
+            )
+        return self.annotate(
+            is_subscribed=Exists(Subscription.objects.filter(
+                author=OuterRef('pk'), subscriber=user
+            ))
+        )
+
+    def adjust_counters(self, pk, **deltas):
+        # Счётчик не уходит ниже нуля, даже если разошёлся со строками.
+        return self.filter(pk=pk).update(**{
+            field: Greatest(F(field) + delta, 0)
+            for field, delta in deltas.items()
+        })
+
+    def touch_cart(self):
+        return self.update(
+            cart_version=F('cart_version') + 1, cart_updated=timezone.now()
+        )
+
+
+class CustomUserManager(UserManager.from_queryset(UserQuerySet)):
+    pass
 
 
 class User(AbstractUser):
@@ -32,6 +63,20 @@ class User(AbstractUser):
         default=False,
         help_text='Пользователь является суперюзером.',
     )
+    recipes_count = models.PositiveIntegerField(
+        'Количество рецептов', default=0, editable=False
+    )
+    subscribers_count = models.PositiveIntegerField(
+        'Количество подписчиков', default=0, editable=False
+    )
+    cart_version = models.PositiveIntegerField(
+        'Версия списка покупок', default=0, editable=False
+    )
+    cart_updated = models.DateTimeField(
+        'Список покупок изменён', null=True, editable=False
+    )
+
+    objects = CustomUserManager()
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']